@@ -1,26 +1,33 @@
 # --- BIBLIOTHÈQUES NÉCESSAIRES ---
+# Uniquement des imports légers ici : chaque rerun Streamlit (et le démarrage à froid)
+# repasse par ce bloc. Les modules lourds sont chargés à la demande :
+#   - fitz (PyMuPDF)         -> pdf_worker.py (sous-processus isolé, voir parse_pdf_isolated)
+#   - pyarrow                -> export des résultats
+#   - duckduckgo_search      -> perform_web_search
+#   - requests / tenacity    -> premier appel API (get_http_session / get_retry_policy)
+#   - pydantic               -> validation des réponses IA (get_response_models)
+# tools/bench_import_time.py vérifie que cela reste vrai.
 import streamlit as st
-import requests 
 import json
 import io
 import time
 import traceback
-import pandas as pd
 import re
 import os
-
-# --- MOTEUR PDF ROBUSTE ---
-import fitz  # PyMuPDF
-
-# --- Imports pour la robustesse ---
-import tenacity
-from requests.exceptions import RequestException, HTTPError, InvalidSchema # Ajouter InvalidSchema
+import csv
+import functools
 import logging
+import threading
+import sys
+import signal
+import subprocess
+import contextlib
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import concurrent.futures.thread
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
-# --- Imports pour API ---
-from duckduckgo_search import DDGS 
 from urllib.parse import urlparse 
-from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type
 
 # --- CONFIGURATION LOGGING ---
 logging.basicConfig(level=logging.INFO)
@@ -37,78 +44,631 @@ st.set_page_config(
     layout="wide"
 )
 
+# --- CONFIGURATION API (OpenRouter UNIQUEMENT) ---
+OPENROUTER_MODEL = "mistralai/mistral-7b-instruct:free"
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions" # SANS crochets
+
+# --- LIMITES D'EXTRACTION PDF (surchargeables par variables d'environnement) ---
+PDF_MAX_BYTES = int(os.environ.get("RHPLUS_PDF_MAX_BYTES", 15 * 1024 * 1024))  # Taille max d'un fichier
+PDF_MAX_PAGES = int(os.environ.get("RHPLUS_PDF_MAX_PAGES", 8))                 # Pages pertinentes extraites au max
+PDF_MAX_SCANNED_PAGES = int(os.environ.get("RHPLUS_PDF_MAX_SCANNED_PAGES", PDF_MAX_PAGES * 3)) # Pages ouvertes au max
+PDF_TIMEOUT_SECONDS = float(os.environ.get("RHPLUS_PDF_TIMEOUT_SECONDS", 20))  # Temps réel / CPU max par document
+PDF_MEMORY_LIMIT_MB = int(os.environ.get("RHPLUS_PDF_MEMORY_MB", 512))         # Mémoire max du sous-processus
+PDF_WORKERS = int(os.environ.get("RHPLUS_PDF_WORKERS", 4))                     # Extractions simultanées
+PDF_WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pdf_worker.py")
+
+# --- MODE PROFILAGE (opt-in : case de la barre latérale ou RHPLUS_PROFILING=1) ---
+PROFILING_DEFAULT = os.environ.get("RHPLUS_PROFILING", "").lower() in ("1", "true", "yes", "on")
+PROFILING_SAMPLE_INTERVAL = float(os.environ.get("RHPLUS_PROFILING_INTERVAL_MS", 5)) / 1000 # Période d'échantillonnage des piles
+PROFILING_TOP_ALLOCATIONS = int(os.environ.get("RHPLUS_PROFILING_TOP", 10))                # Lignes d'allocation affichées par étape
+
 # --- INITIALISATION DU SESSION STATE ---
 if 'all_results' not in st.session_state: st.session_state.all_results = []
 if 'file_contents' not in st.session_state: st.session_state.file_contents = {}
 if 'analysis_done' not in st.session_state: st.session_state.analysis_done = False
 if 'is_running' not in st.session_state: st.session_state.is_running = False
+if 'export_cache' not in st.session_state: st.session_state.export_cache = {}
+if 'profiler' not in st.session_state: st.session_state.profiler = None
+if 'profiling_report' not in st.session_state: st.session_state.profiling_report = None
 
 # --- FONCTIONS UTILITAIRES ---
 
-@st.cache_data
-def convert_df_to_csv(df):
-    """Convertit un DataFrame en CSV pour le téléchargement, gérant listes/dict."""
-    if df.empty: return ""
+# --- RESSOURCES PARTAGÉES (créées une fois par processus, pas à chaque rerun) ---
+@st.cache_resource
+def get_regex_patterns():
+    """Compile une seule fois les regex utilisées pour chaque CV."""
+    return {
+        "cesure": re.compile(r'(\w)-\s*\n\s*(\w)'),
+        "sauts_ligne": re.compile(r'\s*\n\s*'),
+        "sauts_multiples": re.compile(r'\n{3,}'),
+        "espaces_multiples": re.compile(r'[ \t]{2,}'),
+        "alphanum": re.compile(r'[a-zA-Z0-9]'),
+        "ponctuation_seule": re.compile(r'^[\W_]+$'),
+        "mot_cle": re.compile(r'\b[\w\'-]{4,}\b'),
+        "annee": re.compile(r'\b(19\d{2}|20\d{2})\b'),
+        "nom_propre": re.compile(r'^([A-ZÀ-ÖØ-Þ][a-zà-öø-ÿ\'\-]+(?:\s+[A-ZÀ-ÖØ-Þ][a-zà-öø-ÿ\'\-]+)+)'),
+    }
+
+RX = get_regex_patterns()
+
+@st.cache_resource
+def get_api_keys_pool():
+    """Construit le pool de clés OpenRouter à partir de st.secrets."""
+    api_keys_pool = []
+    for secret_name in ("OPENROUTER_API_KEY", "OPENROUTER_API_KEY_2"):
+        if st.secrets.get(secret_name):
+            api_keys_pool.append({"key": st.secrets.get(secret_name), "service": "openrouter", "model": OPENROUTER_MODEL, "url": OPENROUTER_URL})
+    return api_keys_pool
+
+@st.cache_resource
+def get_http_session():
+    """Session requests partagée (connexions HTTP réutilisées entre les appels)."""
+    import requests
+    return requests.Session()
+
+@st.cache_resource
+def get_retry_policy(policy_name):
+    """Politique tenacity nommée, construite au premier appel (import différé de tenacity)."""
+    import tenacity
+    if policy_name == "openrouter":
+        return tenacity.Retrying(
+            wait=tenacity.wait_exponential(multiplier=2, min=3, max=30), 
+            stop=tenacity.stop_after_attempt(3),
+            # Seules les erreurs transport / 429 / 5xx sont réessayées (les erreurs de parsing sont réparées localement)
+            retry=tenacity.retry_if_exception(is_retryable_api_error), 
+            before_sleep=tenacity.before_sleep_log(logger, logging.WARNING),
+            reraise=True
+        )
+    if policy_name == "web_search":
+        return tenacity.Retrying(
+            wait=tenacity.wait_exponential(multiplier=2, min=2, max=20), 
+            stop=tenacity.stop_after_attempt(3),
+            # Nous réessayons sur n'importe quelle Exception générique, 
+            # car DDGS peut lever des erreurs variées (y compris non-HTTP) pour un ratelimit.
+            retry=tenacity.retry_if_exception_type(Exception), 
+            reraise=True
+        )
+    raise ValueError(f"Politique de retry inconnue: {policy_name}")
+
+class ApiTransientError(Exception):
+    """Erreur temporaire signalée dans le corps d'une réponse HTTP 200 (ex: {"error": {"code": 429}} d'OpenRouter)."""
+
+def is_retryable_status(status_code):
+    return status_code == 429 or (isinstance(status_code, int) and 500 <= status_code < 600)
+
+def is_retryable_api_error(exc):
+    """Classe une erreur d'appel API : True seulement pour transport (connexion, timeout), 429 et 5xx."""
+    from requests.exceptions import ConnectionError, Timeout, ChunkedEncodingError, HTTPError
+    if isinstance(exc, HTTPError):
+        return exc.response is not None and is_retryable_status(exc.response.status_code)
+    return isinstance(exc, (ConnectionError, Timeout, ChunkedEncodingError, ApiTransientError))
+
+def with_retry(policy_name):
+    """Équivalent de @tenacity.retry(...) sans importer tenacity au chargement du script."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return get_retry_policy(policy_name).copy()(func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+# --- EXPORT DES RÉSULTATS (Arrow / Parquet / CSV / JSONL en streaming) ---
+EXPORT_CHUNK_SIZE = 1000 # Nombre de résultats traités par lot (row group Parquet / bloc CSV)
+
+@st.cache_resource
+def get_result_arrow_schema():
+    """Schéma Arrow typé d'un final_result (listes et structs natifs)."""
+    import pyarrow as pa
+    return pa.schema([
+        ("nom_fichier", pa.string()),
+        ("nom", pa.string()),
+        ("score", pa.int32()),
+        ("resume_profil", pa.string()),
+        ("contact", pa.struct([("email", pa.string()), ("telephone", pa.string()), ("linkedin", pa.string())])),
+        ("langues", pa.list_(pa.string())),
+        ("diplome_principal", pa.string()),
+        ("annees_experience_estimees", pa.int32()),
+        ("points_forts_cles", pa.list_(pa.string())),
+        ("points_faibles_risques", pa.list_(pa.string())),
+        ("adequation_poste", pa.string()),
+        ("evaluation_technologies_cles", pa.string()),
+        ("analyse_ats", pa.struct([
+            ("mots_cles_trouves", pa.list_(pa.string())),
+            ("mots_cles_manquants", pa.list_(pa.string())),
+            ("stabilite", pa.string()),
+            ("raffinement_ia", pa.bool_()),
+        ])),
+        ("web_links", pa.list_(pa.string())),
+        ("analysis_type", pa.string()),
+        ("statut_extraction", pa.string()),
+    ])
+
+# Colonnes "à plat" du CSV (même ordre que l'ancien export DataFrame)
+EXPORT_CSV_COLUMNS = [
+    "nom_fichier", "nom", "score", "resume_profil", "langues", "diplome_principal", "annees_experience_estimees",
+    "points_forts_cles", "points_faibles_risques", "adequation_poste", "evaluation_technologies_cles",
+    "web_links", "analysis_type", "statut_extraction",
+    "ats.mots_cles_trouves", "ats.mots_cles_manquants", "ats.stabilite", "ats.raffinement_ia",
+    "contact.email", "contact.telephone", "contact.linkedin",
+]
+
+def _as_str(value, default=""):
+    return default if value is None else str(value)
+
+def _as_int(value):
+    try: return int(value)
+    except (ValueError, TypeError): return 0
+
+def _as_str_list(value):
+    return [str(v) for v in value if v is not None] if isinstance(value, list) else []
+
+def normalize_result_for_export(result):
+    """Ramène un final_result au schéma Arrow (types stricts, clés toujours présentes)."""
+    contact = result.get("contact") if isinstance(result.get("contact"), dict) else {}
+    ats = result.get("analyse_ats") if isinstance(result.get("analyse_ats"), dict) else {}
+    return {
+        "nom_fichier": _as_str(result.get("nom_fichier")),
+        "nom": _as_str(result.get("nom"), "N/A"),
+        "score": _as_int(result.get("score")),
+        "resume_profil": _as_str(result.get("resume_profil"), "N/A"),
+        "contact": {k: _as_str(contact.get(k)) for k in ("email", "telephone", "linkedin")},
+        "langues": _as_str_list(result.get("langues")),
+        "diplome_principal": _as_str(result.get("diplome_principal")),
+        "annees_experience_estimees": _as_int(result.get("annees_experience_estimees")),
+        "points_forts_cles": _as_str_list(result.get("points_forts_cles")),
+        "points_faibles_risques": _as_str_list(result.get("points_faibles_risques")),
+        "adequation_poste": _as_str(result.get("adequation_poste")),
+        "evaluation_technologies_cles": _as_str(result.get("evaluation_technologies_cles")),
+        "analyse_ats": {
+            "mots_cles_trouves": _as_str_list(ats.get("mots_cles_trouves")),
+            "mots_cles_manquants": _as_str_list(ats.get("mots_cles_manquants")),
+            "stabilite": _as_str(ats.get("stabilite"), "N/A"),
+            "raffinement_ia": bool(ats.get("raffinement_ia", False)),
+        },
+        "web_links": _as_str_list(result.get("web_links")),
+        "analysis_type": _as_str(result.get("analysis_type"), "Échec"),
+        "statut_extraction": _as_str(result.get("statut_extraction"), "N/A"),
+    }
+
+def _flatten_result_for_csv(row):
+    """Aplatit un résultat normalisé (listes jointes par '; ', struct -> colonnes pointées)."""
+    ats, contact = row["analyse_ats"], row["contact"]
+    return [
+        row["nom_fichier"], row["nom"], row["score"], row["resume_profil"], "; ".join(row["langues"]),
+        row["diplome_principal"], row["annees_experience_estimees"],
+        "; ".join(row["points_forts_cles"]), "; ".join(row["points_faibles_risques"]),
+        row["adequation_poste"], row["evaluation_technologies_cles"],
+        "; ".join(row["web_links"]), row["analysis_type"], row["statut_extraction"],
+        "; ".join(ats["mots_cles_trouves"]), "; ".join(ats["mots_cles_manquants"]), ats["stabilite"], ats["raffinement_ia"],
+        contact["email"], contact["telephone"], contact["linkedin"],
+    ]
+
+def _iter_chunks(results, chunk_size):
+    for start in range(0, len(results), chunk_size):
+        yield [normalize_result_for_export(r) for r in results[start:start + chunk_size]]
+
+def write_results_parquet(results, sink, chunk_size=EXPORT_CHUNK_SIZE):
+    """Écrit les résultats en Parquet, un row group par lot (mémoire bornée par chunk_size)."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = get_result_arrow_schema()
+    with pq.ParquetWriter(sink, schema, compression="zstd") as writer:
+        for chunk in _iter_chunks(results, chunk_size):
+            writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+
+def write_results_csv(results, sink, chunk_size=EXPORT_CHUNK_SIZE):
+    """Écrit les résultats à plat en CSV (UTF-8 BOM pour Excel) dans un flux binaire, lot par lot."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    sink.write("\ufeff".encode("utf-8"))
+    writer.writerow(EXPORT_CSV_COLUMNS)
+    for chunk in _iter_chunks(results, chunk_size):
+        writer.writerows(_flatten_result_for_csv(row) for row in chunk)
+        sink.write(buffer.getvalue().encode("utf-8"))
+        buffer.seek(0); buffer.truncate()
+    sink.write(buffer.getvalue().encode("utf-8"))
+
+def write_results_jsonl(results, sink, chunk_size=EXPORT_CHUNK_SIZE):
+    """Écrit un résultat normalisé par ligne (JSON Lines) dans un flux binaire, lot par lot."""
+    for chunk in _iter_chunks(results, chunk_size):
+        sink.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in chunk).encode("utf-8"))
+
+EXPORT_WRITERS = {
+    "csv": (write_results_csv, "text/csv"),
+    "jsonl": (write_results_jsonl, "application/x-ndjson"),
+    "parquet": (write_results_parquet, "application/vnd.apache.parquet"),
+}
+
+def get_export_bytes(fmt):
+    """Génère à la demande le fichier d'export au format demandé.
+
+    st.download_button exige le fichier complet en mémoire : seul le dernier format préparé
+    est conservé (l'écriture elle-même reste par lots).
+    """
+    cache = st.session_state.export_cache
+    if fmt not in cache:
+        writer, _ = EXPORT_WRITERS[fmt]
+        sink = io.BytesIO()
+        with profiled_stage(f"export_{fmt}"):
+            writer(st.session_state.all_results, sink)
+        cache.clear()
+        cache[fmt] = sink.getvalue()
+    return cache[fmt]
+
+# --- ÉTAPE 0: EXTRACTION PDF (PyMuPDF, dans un sous-processus isolé) ---
+PDF_STATUS_LABELS = {
+    "ok": "OK", "tronque": "Tronqué", "trop_volumineux": "Fichier trop volumineux",
+    "delai_depasse": "Délai d'extraction dépassé", "memoire": "Mémoire dépassée",
+    "erreur": "PDF illisible", "vide": "Texte non extractible",
+}
+
+# Codes retour d'un worker tué par la limite CPU ou le noyau (signaux absents sous Windows)
+PDF_KILLED_RETURNCODES = {-getattr(signal, name) for name in ("SIGXCPU", "SIGKILL") if hasattr(signal, name)}
+
+def parse_pdf_isolated(file_bytes):
+    """Lance pdf_worker.py avec les limites PDF_* et renvoie son résultat (dict avec "statut").
+
+    Sans appel Streamlit : peut tourner dans un thread. Ne lève jamais d'exception : un document
+    qui dépasse le délai ou la mémoire est tué, une erreur imprévue devient le statut "erreur",
+    et le lot continue.
+    """
     try:
-        df_copy = df.copy()
-        for col in df_copy.columns:
-            if col in df_copy.columns and not df_copy[col].dropna().empty:
-                 first_valid = df_copy[col].dropna().iloc[0]
-                 if isinstance(first_valid, (list, dict)):
-                      df_copy[col] = df_copy[col].apply(lambda x: json.dumps(x, ensure_ascii=False) if isinstance(x, (list, dict)) else str(x))
-                 else:
-                      df_copy[col] = df_copy[col].astype(str)
-            else:
-                 df_copy[col] = df_copy[col].astype(str)
-                 
-        return df_copy.to_csv(index=False, encoding='utf-8-sig')
+        return _run_pdf_worker(file_bytes)
     except Exception as e:
-        st.error(f"Erreur conversion CSV: {e}")
-        try: return df.to_string(index=False) 
-        except: return ""
-
-# --- ÉTAPE 0: EXTRACTION PDF (PyMuPDF) ---
-def extract_text_from_pdf(file_bytes_io, filename):
-    """Extrait et nettoie le texte d'un PDF avec PyMuPDF."""
-    text = ""
+        logger.exception("Erreur inattendue du worker PDF:")
+        return {"statut": "erreur", "message": f"{type(e).__name__}: {e}"[:300]}
+
+def _run_pdf_worker(file_bytes):
+    if len(file_bytes) > PDF_MAX_BYTES:
+        return {"statut": "trop_volumineux", "message": f"{len(file_bytes) / 1e6:.1f} Mo > {PDF_MAX_BYTES / 1e6:.0f} Mo"}
+    cmd = [
+        sys.executable, PDF_WORKER_PATH,
+        "--max-pages", str(PDF_MAX_PAGES), "--max-scanned-pages", str(PDF_MAX_SCANNED_PAGES),
+        "--memory-mb", str(PDF_MEMORY_LIMIT_MB), "--cpu-seconds", str(max(1, int(PDF_TIMEOUT_SECONDS))),
+    ]
     try:
-        with fitz.open(stream=file_bytes_io, filetype="pdf") as doc:
-            for page in doc: 
-                text += page.get_text("text", sort=True, flags=fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE) + "\n"
-        text = text.strip()
-        if text:
-            text = re.sub(r'(\w)-\s*\n\s*(\w)', r'\1\2', text) 
-            text = re.sub(r'\s*\n\s*', '\n', text) 
-            text = re.sub(r'\n{3,}', '\n\n', text) 
-            text = re.sub(r'[ \t]{2,}', ' ', text) 
-            text = "\n".join(line for line in text.splitlines() if len(line.strip()) > 3 or '@' in line or '+' in line or 'http' in line)
-            text = "\n".join(line for line in text.splitlines() if re.search(r'[a-zA-Z0-9]', line)) 
-            text = "\n".join(line for line in text.splitlines() if not re.match(r'^[\W_]+$', line.strip())) 
-            text = "\n".join(line for line in text.splitlines() if not (line.strip().isdigit() and len(line.strip()) < 4 and len(text.splitlines()) > 10)) 
-            return text
-        else:
-            st.warning(f"PDF {filename} vide ou texte non extractible (PyMuPDF).")
-            return None
+        proc = subprocess.run(cmd, input=file_bytes, capture_output=True, timeout=PDF_TIMEOUT_SECONDS)
+    except subprocess.TimeoutExpired: # subprocess.run tue le processus
+        return {"statut": "delai_depasse", "message": f"> {PDF_TIMEOUT_SECONDS:.0f}s"}
+    except OSError as e:
+        return {"statut": "erreur", "message": f"Lancement du worker PDF impossible: {e}"}
+
+    stderr_tail = proc.stderr.decode("utf-8", "replace")[-500:]
+    if proc.returncode == 0:
+        try: parsed = json.loads(proc.stdout)
+        except json.JSONDecodeError: parsed = None
+        if isinstance(parsed, dict) and "statut" in parsed: return parsed
+        return {"statut": "erreur", "message": "Réponse du worker PDF invalide."}
+    if proc.returncode in PDF_KILLED_RETURNCODES:
+        return {"statut": "delai_depasse", "message": f"> {PDF_TIMEOUT_SECONDS:.0f}s CPU"}
+    if "MemoryError" in stderr_tail or "cannot allocate" in stderr_tail.lower():
+        return {"statut": "memoire", "message": f"> {PDF_MEMORY_LIMIT_MB} Mo"}
+    return {"statut": "erreur", "message": f"Worker PDF terminé (code {proc.returncode}): {stderr_tail[-200:]}"}
+
+def describe_pdf_status(parsed):
+    """Libellé du statut d'extraction par fichier (affiché et exporté)."""
+    label = PDF_STATUS_LABELS.get(parsed.get("statut"), "PDF illisible")
+    if parsed.get("statut") == "tronque":
+        return f"{label} ({parsed.get('pages_retenues', 0)} pages extraites, {parsed.get('pages_lues', 0)}/{parsed.get('pages_total', 0)} lues)"
+    if parsed.get("message"): return f"{label} ({parsed['message']})"
+    return label
+
+def clean_extracted_text(text):
+    """Nettoie le texte brut d'un PDF (césures, espaces, lignes parasites)."""
+    text = RX["cesure"].sub(r'\1\2', text) 
+    text = RX["sauts_ligne"].sub('\n', text) 
+    text = RX["sauts_multiples"].sub('\n\n', text) 
+    text = RX["espaces_multiples"].sub(' ', text) 
+    text = "\n".join(line for line in text.splitlines() if len(line.strip()) > 3 or '@' in line or '+' in line or 'http' in line)
+    text = "\n".join(line for line in text.splitlines() if RX["alphanum"].search(line)) 
+    text = "\n".join(line for line in text.splitlines() if not RX["ponctuation_seule"].match(line.strip())) 
+    text = "\n".join(line for line in text.splitlines() if not (line.strip().isdigit() and len(line.strip()) < 4 and len(text.splitlines()) > 10)) 
+    return text
+
+def extract_text_from_pdf(file_bytes_io, filename, parsed=None):
+    """Extrait et nettoie le texte d'un PDF. Retourne (texte ou None, statut d'extraction).
+
+    `parsed` permet de fournir un résultat de parse_pdf_isolated déjà calculé (extraction en parallèle).
+    """
+    if parsed is None: parsed = parse_pdf_isolated(file_bytes_io.getvalue())
+    try:
+        statut = parsed.get("statut")
+        text = (parsed.get("texte") or "").strip()
+        if statut in ("ok", "tronque") and not text:
+            parsed = dict(parsed, statut="vide")
+        status_label = describe_pdf_status(parsed)
+        if parsed["statut"] not in ("ok", "tronque"):
+            if parsed["statut"] == "vide": st.warning(f"PDF {filename} vide ou texte non extractible (PyMuPDF).")
+            else: st.error(f"Extraction PDF {filename} interrompue : {status_label}")
+            logger.warning(f"Extraction PDF {filename}: {status_label}")
+            return None, status_label
+        if statut == "tronque":
+            st.info(f"PDF {filename} volumineux : {status_label}.", icon="✂️")
+        return clean_extracted_text(text), status_label
     except Exception as e:
         st.error(f"Erreur extraction PDF (PyMuPDF) pour {filename}: {e}")
         logger.exception(f"Traceback complet extraction PDF pour {filename}:")
-        return None
+        return None, PDF_STATUS_LABELS["erreur"]
+
+# --- EXTRACTION LOCALE DÉTERMINISTE (contact, langues, expérience) ---
+# Remplit les champs du screening (Étape 1) sans appel IA, avec un score de confiance par champ.
+# Seuls les champs sous LOCAL_CONFIDENCE_THRESHOLD sont demandés à l'IA ; si tous sont au-dessus, l'appel est évité.
+LOCAL_CONFIDENCE_THRESHOLD = 0.8
+LOCAL_PROFILE_FIELDS = ["nom", "contact.email", "contact.telephone", "contact.linkedin", "langues", "diplome_principal", "annees_experience_estimees"]
+
+_MONTHS = {
+    1: ["janvier", "janv", "jan", "january"], 2: ["février", "fevrier", "févr", "fevr", "fév", "fev", "february", "feb"],
+    3: ["mars", "march", "mar"], 4: ["avril", "april", "avr", "apr"], 5: ["mai", "may"], 6: ["juin", "june", "jun"],
+    7: ["juillet", "juil", "july", "jul"], 8: ["août", "aout", "august", "aug"], 9: ["septembre", "september", "sept", "sep"],
+    10: ["octobre", "october", "oct"], 11: ["novembre", "november", "nov"], 12: ["décembre", "decembre", "december", "déc", "dec"],
+}
+MONTH_NUMBERS = {name: number for number, names in _MONTHS.items() for name in names}
+_MONTH_ALT = "|".join(sorted(MONTH_NUMBERS, key=len, reverse=True))
+_DATE = r'\b(?:(?P<{p}m>' + _MONTH_ALT + r')\.?\s*|(?P<{p}n>0?[1-9]|1[0-2])\s*[/.\-]\s*)?(?P<{p}y>(?:19|20)\d{{2}})'
+_NOW = r"(?P<now>présent|present|aujourd['’]hui|actuel(?:lement)?|now|current|en cours|ce jour)"
+
+LANGUAGE_NAMES = {
+    "français": "Français", "francais": "Français", "french": "Français", "anglais": "Anglais", "english": "Anglais",
+    "espagnol": "Espagnol", "spanish": "Espagnol", "allemand": "Allemand", "german": "Allemand",
+    "italien": "Italien", "italian": "Italien", "portugais": "Portugais", "portuguese": "Portugais",
+    "arabe": "Arabe", "arabic": "Arabe", "chinois": "Chinois", "mandarin": "Chinois", "chinese": "Chinois",
+    "russe": "Russe", "russian": "Russe", "japonais": "Japonais", "japanese": "Japonais",
+    "néerlandais": "Néerlandais", "neerlandais": "Néerlandais", "dutch": "Néerlandais", "turc": "Turc", "turkish": "Turc",
+    "polonais": "Polonais", "polish": "Polonais", "roumain": "Roumain", "romanian": "Roumain",
+    "hindi": "Hindi", "coréen": "Coréen", "korean": "Coréen", "wolof": "Wolof",
+}
+_LANG_ALT = "|".join(sorted(LANGUAGE_NAMES, key=len, reverse=True))
+_LEVEL_ALT = (r"[abc][12]|natif|native|maternelle|langue maternelle|bilingue|bilingual|courant|fluent|"
+              r"professionnel|professional|intermédiaire|intermediate|avancé|advanced|notions|débutant|beginner|scolaire|lu,? écrit,? parlé|toeic\s*\d{3}|toefl\s*\d{2,3}|ielts\s*\d(?:\.\d)?")
+
+# Titres de sections (ligne seule) : la section Formation va jusqu'au titre suivant
+_SECTION_EDUCATION = (r"formations?|[ée]ducation|dipl[ôo]mes?(?:\s+et\s+formations?)?|[ée]tudes|cursus(?:\s+scolaire)?|"
+                      r"parcours\s+(?:acad[ée]mique|scolaire)|formation\s+acad[ée]mique|academic\s+background")
+_SECTION_OTHER = (r"exp[ée]riences?(?:\s+professionnelles?)?|professional\s+experience|work\s+experience|employment|"
+                  r"parcours\s+professionnel|comp[ée]tences(?:\s+techniques)?|skills|langues?|languages?|projets?|projects|"
+                  r"certifications?|centres?\s+d.int[ée]r[êe]ts?|loisirs|interests|hobbies|b[ée]n[ée]volat|publications|"
+                  r"r[ée]f[ée]rences|profil|summary|contact")
+
+# Diplômes du plus élevé au moins élevé (le premier trouvé dans cet ordre l'emporte)
+DEGREE_RANKS = [
+    r"doctorat|ph\.?\s?d", r"dipl[ôo]me d.ing[ée]nieur|ing[ée]nieur", r"master|mast[èe]re|msc|mba|bac\s*\+\s*5",
+    r"licence|bachelor|bac\s*\+\s*3", r"bts|dut|bac\s*\+\s*2", r"baccalaur[ée]at|bac\b", r"cap|bep",
+]
+
+@st.cache_resource
+def get_local_extractor_patterns():
+    """Compile une seule fois les regex de l'extracteur local.
+
+    Les motifs sans re.IGNORECASE s'appliquent au texte déjà passé en minuscules (nettement plus rapide).
+    """
+    date_range = _DATE.format(p="d1") + r"\s*(?:-|–|—|→|à|au|a|to|until|jusqu['’](?:à|en))\s*(?:" + _DATE.format(p="d2") + "|" + _NOW + ")"
+    return {
+        "email": re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+'),
+        "telephone_fr": re.compile(r'(?<![\d+])(?:(?:\+|00)33\s?(?:\(0\)\s?)?[1-9]|0[1-9])(?:[\s.\-]?\d{2}){4}(?!\d)'),
+        "telephone_intl": re.compile(r'(?<![\d+])\+\d{1,3}[\s.\-]?(?:\(\d+\)[\s.\-]?)?\d[\d\s.\-]{6,14}\d(?!\d)'),
+        "linkedin": re.compile(r'(?:https?://)?(?:[a-z]{2,3}\.)?linkedin\.com/in/[\w\-%.]+'),
+        "plage_dates": re.compile(date_range),
+        "depuis": re.compile(r"\bdepuis\s+(?:le\s+)?" + _DATE.format(p="d1")),
+        "ligne_formation": re.compile(r"\b(?:master|mast[èe]re|licence|bachelor|bts|dut|bac|baccalaur[ée]at|dipl[ôo]me|formation|universit[ée]|university|[ée]cole|school|lyc[ée]e|doctorat|iut|mba|[ée]tudes|education|cursus)\b", re.IGNORECASE),
+        "titre_section": re.compile(r"^[\s#*•\-]*(?:(?P<formation>" + _SECTION_EDUCATION + r")|" + _SECTION_OTHER + r")\s*:?\s*$", re.MULTILINE),
+        "titre_langues": re.compile(r"^\s*(?:langues?|languages?|compétences linguistiques)\s*:?", re.IGNORECASE | re.MULTILINE),
+        "langue": re.compile(r"\b(" + _LANG_ALT + r")\b(?:\s*[:(\-–,]?\s*(" + _LEVEL_ALT + r"))?"),
+        "diplome": re.compile(r"\b(?:" + "|".join(f"(?P<rang{rank}>{alt})" for rank, alt in enumerate(DEGREE_RANKS)) + r")\b"),
+        "nom_ligne": re.compile(r"^\s*([A-ZÀ-ÖØ-Þ][A-Za-zÀ-ÖØ-öø-ÿ'\-]+(?:\s+[A-ZÀ-ÖØ-Þ][A-Za-zÀ-ÖØ-öø-ÿ'\-]+){1,3})\s*$"),
+    }
+
+def _month_index(year, month):
+    return int(year) * 12 + (int(month) - 1)
+
+def _date_to_month_index(match, prefix):
+    month_name, month_num, year = match.group(f"{prefix}m"), match.group(f"{prefix}n"), match.group(f"{prefix}y")
+    if month_name: return _month_index(year, MONTH_NUMBERS[month_name]), True
+    if month_num: return _month_index(year, month_num), True
+    return _month_index(year, 7), False # Année seule : milieu d'année (ni sur- ni sous-estimée en moyenne)
+
+def education_spans(lowered):
+    """Plages de caractères des sections Formation / Éducation (du titre au titre de section suivant)."""
+    headers = list(get_local_extractor_patterns()["titre_section"].finditer(lowered))
+    return [(header.end(), headers[k + 1].start() if k + 1 < len(headers) else len(lowered))
+            for k, header in enumerate(headers) if header.group("formation")]
+
+def _in_spans(position, spans):
+    return any(start <= position < end for start, end in spans)
+
+def extract_date_ranges(cv_text, today=None, education=None):
+    """Plages de dates du CV -> [{"debut", "fin", "mois", "formation", "formation_incertaine"}] (indices en mois, fin exclusive).
+
+    Une plage est une formation si elle est dans une section Formation. Sans titre de section, les lignes
+    citant une école ou un diplôme sont écartées faute de mieux, mais marquées "formation_incertaine"
+    (un "Scrum Master" ou une "École" employeuse peuvent être des postes).
+    """
+    patterns = get_local_extractor_patterns()
+    cv_text = cv_text.lower()
+    if education is None: education = education_spans(cv_text)
+    today = today or time.localtime()
+    now_index = _month_index(today.tm_year, today.tm_mon)
+    ranges = []
+    for pattern in (patterns["plage_dates"], patterns["depuis"]):
+        for match in pattern.finditer(cv_text):
+            start, _ = _date_to_month_index(match, "d1")
+            if "d2y" in pattern.groupindex and match.group("d2y"):
+                end, has_month = _date_to_month_index(match, "d2")
+                if has_month: end += 1 # Mois de fin inclus
+            else:
+                end = now_index + 1
+            if not 0 < end - start <= 50 * 12: continue
+            line_start = cv_text.rfind("\n", 0, match.start()) + 1
+            line_end = cv_text.find("\n", match.end())
+            line = cv_text[line_start:line_end if line_end >= 0 else len(cv_text)]
+            if education: formation, incertaine = _in_spans(match.start(), education), False
+            else: formation = incertaine = bool(patterns["ligne_formation"].search(line))
+            ranges.append({"debut": start, "fin": end, "mois": end - start, "formation": formation, "formation_incertaine": incertaine})
+    return ranges
+
+def _merged_months(ranges):
+    """Total de mois couverts par des plages (chevauchements fusionnés)."""
+    total, current_start, current_end = 0, None, None
+    for r in sorted(ranges, key=lambda r: r["debut"]):
+        if current_end is None or r["debut"] > current_end:
+            if current_end is not None: total += current_end - current_start
+            current_start, current_end = r["debut"], r["fin"]
+        else:
+            current_end = max(current_end, r["fin"])
+    if current_end is not None: total += current_end - current_start
+    return total
+
+def _strip_accents_lower(text):
+    import unicodedata
+    return "".join(c for c in unicodedata.normalize("NFKD", text.lower()) if not unicodedata.combining(c))
 
-# --- FONCTION ANALYSE LOCALE (Mots-clés + Stabilité Simple) ---
-def perform_local_analysis(cv_text, job_description_text):
-    """Effectue une analyse basique locale (mots-clés, tentative stabilité)."""
+def extract_local_profile(cv_text):
+    """Extrait localement les champs du screening avec une confiance (0-1) par champ.
+
+    Retourne {"champs": {champ: {"valeur", "confiance"}}, "periodes": [...]} ; les champs suivent
+    LOCAL_PROFILE_FIELDS (les clés "contact.x" correspondent au sous-objet contact).
+    """
+    patterns = get_local_extractor_patterns()
+    lowered = cv_text.lower()
+    # Les positions trouvées dans `lowered` valent pour cv_text si lower() n'a pas changé la longueur
+    source = cv_text if len(lowered) == len(cv_text) else lowered
+    lines = cv_text.splitlines()
+    fields = {}
+
+    email_match = patterns["email"].search(cv_text)
+    email = email_match.group(0).strip(".") if email_match else ""
+    # Absence certaine si le texte ne contient même pas "@" / "linkedin" : inutile d'interroger l'IA
+    fields["contact.email"] = {"valeur": email, "confiance": 0.99 if email or "@" not in cv_text else 0.5}
+
+    phone_match = patterns["telephone_fr"].search(cv_text) or patterns["telephone_intl"].search(cv_text)
+    telephone = re.sub(r"\s+", " ", phone_match.group(0)).strip() if phone_match else ""
+    fields["contact.telephone"] = {"valeur": telephone, "confiance": 0.95 if telephone else 0.5}
+
+    linkedin_match = patterns["linkedin"].search(lowered) if "linkedin" in lowered else None
+    linkedin = ""
+    if linkedin_match:
+        linkedin = source[linkedin_match.start():linkedin_match.end()].rstrip(".")
+        if not linkedin.lower().startswith("http"): linkedin = "https://" + linkedin
+    fields["contact.linkedin"] = {"valeur": linkedin, "confiance": 0.99 if linkedin or "linkedin" not in lowered else 0.6}
+
+    # Nom : ligne "Prénom Nom" en tête de CV, confirmée si elle correspond à l'email
+    nom, nom_confidence = "", 0.3
+    for line in lines[:6]:
+        name_match = patterns["nom_ligne"].match(line)
+        if name_match and "@" not in line:
+            nom, nom_confidence = name_match.group(1).strip(), 0.6
+            email_local = _strip_accents_lower(email.split("@")[0]) if email else ""
+            if email_local and any(len(token) >= 3 and token in email_local for token in _strip_accents_lower(nom).split()):
+                nom_confidence = 0.9
+            break
+    fields["nom"] = {"valeur": nom, "confiance": nom_confidence}
+
+    # Langues : section "Langues" explicite = confiance élevée, mentions isolées = faible
+    header = patterns["titre_langues"].search(cv_text)
+    scope = lowered[header.start():header.start() + 400] if header else lowered
+    langues, seen = [], set()
+    for match in patterns["langue"].finditer(scope):
+        langue = LANGUAGE_NAMES[match.group(1)]
+        if langue in seen: continue
+        seen.add(langue)
+        level = match.group(2)
+        if level: level = level.upper() if len(level) == 2 else level.strip()
+        langues.append(f"{langue} ({level})" if level else langue)
+    fields["langues"] = {"valeur": langues, "confiance": 0.9 if header and langues else (0.6 if langues else 0.4)}
+
+    # Diplôme principal : le plus élevé de la section Formation, sinon des lignes citant une formation.
+    # Hors section, la confiance reste sous le seuil : "Ingénieur DevOps" ou "Scrum Master" sont des postes.
+    education = education_spans(lowered)
+    line_spans = [(m.start(), m.end()) for m in re.finditer(r"[^\n]+", lowered)]
+    section_lines = [span for span in line_spans if _in_spans(span[0], education)]
+    keyword_lines = [span for span in line_spans if not _in_spans(span[0], education) and patterns["ligne_formation"].search(lowered, *span)]
+    diplome, diplome_confidence = "", 0.4
+    for candidate_lines, in_section in ((section_lines, True), (keyword_lines, False)):
+        best = min(((int(m.lastgroup[4:]), start, end) for start, end in candidate_lines
+                    for m in patterns["diplome"].finditer(lowered, start, end)), default=None)
+        if best is None: continue
+        _, line_start, line_end = best
+        line = source[line_start:line_end]
+        diplome = line.strip()[:100]
+        if in_section: diplome_confidence = 0.85 if RX["annee"].search(line) else 0.65
+        elif patterns["plage_dates"].search(lowered, line_start, line_end): diplome_confidence = 0.5 # Ligne datée comme un poste
+        else: diplome_confidence = 0.7 if RX["annee"].search(line) else 0.6
+        break
+    fields["diplome_principal"] = {"valeur": diplome, "confiance": diplome_confidence}
+
+    # Expérience : somme des plages de dates professionnelles (chevauchements fusionnés).
+    # Une plage écartée sans section Formation pour la confirmer rend l'estimation incertaine.
+    periodes = extract_date_ranges(cv_text, education=education)
+    postes = [p for p in periodes if not p["formation"]]
+    annees = round(_merged_months(postes) / 12)
+    incertaine = any(p["formation_incertaine"] for p in periodes)
+    fields["annees_experience_estimees"] = {"valeur": annees, "confiance": 0.85 if len(postes) >= 2 and not incertaine else (0.6 if postes else 0.4)}
+
+    return {"champs": fields, "periodes": periodes}
+
+def local_screening_values(local_profile):
+    """Valeurs locales au format du screening (même schéma que la réponse IA)."""
+    fields = local_profile["champs"]
+    return {
+        "nom": fields["nom"]["valeur"],
+        "contact": {key: fields[f"contact.{key}"]["valeur"] for key in ("email", "telephone", "linkedin")},
+        "langues": list(fields["langues"]["valeur"]),
+        "diplome_principal": fields["diplome_principal"]["valeur"],
+        "annees_experience_estimees": fields["annees_experience_estimees"]["valeur"],
+    }
+
+def low_confidence_fields(local_profile, threshold=LOCAL_CONFIDENCE_THRESHOLD):
+    """Champs (LOCAL_PROFILE_FIELDS) dont la confiance locale est insuffisante -> à demander à l'IA."""
+    return [field for field in LOCAL_PROFILE_FIELDS if local_profile["champs"][field]["confiance"] < threshold]
+
+def merge_screening_data(local_profile, ia_data, requested_fields):
+    """Fusionne local + IA : l'IA ne remplace que les champs demandés, et seulement si sa valeur est non vide."""
+    merged = local_screening_values(local_profile)
+    if not ia_data: return merged
+    for field in requested_fields:
+        if field.startswith("contact."):
+            key = field.split(".", 1)[1]
+            value = (ia_data.get("contact") or {}).get(key)
+            if value: merged["contact"][key] = value
+        elif ia_data.get(field):
+            merged[field] = ia_data[field]
+    return merged
+
+# --- FONCTION ANALYSE LOCALE (Mots-clés + Stabilité) ---
+def describe_tenure(periodes):
+    """Stabilité à partir des plages de dates professionnelles : ancienneté moyenne par poste."""
+    postes = [p for p in periodes if not p["formation"]]
+    if not postes: return None
+    moyenne = sum(p["mois"] for p in postes) / len(postes) / 12
+    total = _merged_months(postes) / 12
+    debut = min(p["debut"] for p in postes) // 12
+    fin = (max(p["fin"] for p in postes) - 1) // 12
+    if moyenne >= 2: label = "Parcours stable"
+    elif moyenne >= 1: label = "Stabilité moyenne"
+    else: label = "Postes courts"
+    description = (f"{label} : ancienneté moyenne {moyenne:.1f} an(s) sur {len(postes)} poste(s) "
+                   f"({debut} - {fin}, {total:.1f} an(s) d'expérience cumulée)")
+    if any(p.get("formation_incertaine") for p in periodes):
+        description += " — à confirmer (des plages écartées comme formation peuvent être des postes)"
+    return description
+
+def perform_local_analysis(cv_text, job_description_text, local_profile=None):
+    """Effectue une analyse basique locale (mots-clés, stabilité calculée sur les plages de dates)."""
     analysis = {"mots_cles_trouves": [], "mots_cles_manquants": [], "stabilite": "N/A"}
     try:
-        job_keywords = set(re.findall(r'\b[\w\'-]{4,}\b', job_description_text.lower()))
-        cv_words = set(re.findall(r'\b[\w\'-]{4,}\b', cv_text.lower()))
+        job_keywords = set(RX["mot_cle"].findall(job_description_text.lower()))
+        cv_words = set(RX["mot_cle"].findall(cv_text.lower()))
         
         if job_keywords: 
              analysis["mots_cles_trouves"] = sorted(list(job_keywords.intersection(cv_words)))[:15] 
              analysis["mots_cles_manquants"] = sorted(list(job_keywords - cv_words))[:10] 
         
-        years = re.findall(r'\b(19\d{2}|20\d{2})\b', cv_text) 
+        periodes = local_profile["periodes"] if local_profile else extract_date_ranges(cv_text)
+        tenure = describe_tenure(periodes)
+        years = RX["annee"].findall(cv_text) 
         unique_years = sorted(list(set(years)))
-        if len(unique_years) > 2: 
+        if tenure:
+             analysis["stabilite"] = tenure
+        elif len(unique_years) > 2: 
              analysis["stabilite"] = f"Potentiel parcours stable ({unique_years[0]} - {unique_years[-1]})"
         elif len(unique_years) > 0:
              analysis["stabilite"] = f"Parcours potentiellement récent (années: {', '.join(unique_years)})"
@@ -130,13 +690,13 @@ def get_basic_fallback_info(cv_text, job_description_text, filename):
         "analysis_type": "Basique + Mots Clés Locaux" 
     }
     try:
-        job_keywords = set(re.findall(r'\b[\w\'-]{4,}\b', job_description_text.lower()))
-        cv_words = set(re.findall(r'\b[\w\'-]{4,}\b', cv_text.lower()))
+        job_keywords = set(RX["mot_cle"].findall(job_description_text.lower()))
+        cv_words = set(RX["mot_cle"].findall(cv_text.lower()))
         match_percentage = (len(job_keywords.intersection(cv_words)) / len(job_keywords)) * 100 if job_keywords else 0
         result["score"] = min(int(match_percentage), 70) 
 
         first_lines = "\n".join(cv_text.splitlines()[:5])
-        name_match = re.search(r'^([A-ZÀ-ÖØ-Þ][a-zà-öø-ÿ\'\-]+(?:\s+[A-ZÀ-ÖØ-Þ][a-zà-öø-ÿ\'\-]+)+)', first_lines)
+        name_match = RX["nom_propre"].search(first_lines)
         if name_match: result["nom"] = name_match.group(1).strip() + " (Ext. Basique)"
 
     except Exception as e:
@@ -144,17 +704,186 @@ def get_basic_fallback_info(cv_text, job_description_text, filename):
         result.update({"nom": "Erreur Fallback", "score": 0, "resume_profil": "Erreur fallback."})
     return result
 
+# --- PARSING DES RÉPONSES IA (JSON tolérant + schémas pydantic) ---
+# Une réponse mal formée est réparée localement : on ne repaie jamais un appel IA pour une erreur de parsing.
+_JSON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+def _strip_code_fences(text):
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else text.lstrip("`")
+        if text.rstrip().endswith("```"): text = text.rstrip()[:-3]
+    return text.strip().strip('`')
+
+def _is_string_end(text, i):
+    """Un guillemet ne ferme une chaîne que s'il est suivi d'un séparateur JSON (sinon guillemet interne)."""
+    j = i + 1
+    while j < len(text) and text[j] in " \t\r\n": j += 1
+    return j >= len(text) or text[j] in ",:}]"
+
+def repair_json(text):
+    """Répare les défauts JSON courants des LLM et retourne l'objet Python (ValueError si irrécupérable).
+
+    Gère : balises ```json, texte autour du JSON, échappements invalides (\\_), guillemets simples,
+    virgules finales, littéraux Python (True/None) et objets tronqués (fermés automatiquement).
+    """
+    text = _strip_code_fences(text)
+    try: return json.loads(text, strict=False)
+    except json.JSONDecodeError: pass
+
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts: raise ValueError("Aucun objet JSON trouvé dans la réponse.")
+    text = text[min(starts):]
+
+    out, stack, quote, i = [], [], None, 0
+    while i < len(text):
+        c = text[i]
+        if quote: # --- À l'intérieur d'une chaîne ---
+            if c == "\\":
+                nxt = text[i + 1] if i + 1 < len(text) else ""
+                if nxt and nxt in '"\\/bfnrtu': out.append(c + nxt)
+                elif nxt: out.append(nxt) # Échappement invalide (\_ , \*, \') : on garde le caractère
+                i += 2; continue
+            if c == quote and _is_string_end(text, i):
+                out.append('"'); quote = None
+            elif c == '"': out.append('\\"')
+            else: out.append(c)
+            i += 1; continue
+        # --- Hors chaîne ---
+        if c in "\"'":
+            quote = c; out.append('"')
+        elif c in "{[":
+            stack.append("}" if c == "{" else "]"); out.append(c)
+        elif c in "}]":
+            while out and out[-1] in " \t\r\n,": out.pop() # Virgule finale
+            if stack: stack.pop()
+            out.append(c)
+            if not stack: break # Fin de la valeur principale : le texte qui suit est ignoré
+        else:
+            literal = next((lit for lit in _JSON_LITERALS if text.startswith(lit, i)), None)
+            if literal:
+                out.append(_JSON_LITERALS[literal]); i += len(literal); continue
+            out.append(c)
+        i += 1
+
+    repaired = "".join(out)
+    if quote: repaired += '"' # Chaîne tronquée
+    if stack: # Objet tronqué : retirer la paire clé/valeur incomplète puis refermer
+        repaired = re.sub(r'[\s,:]+$', '', repaired)
+        if stack[-1] == "}": repaired = re.sub(r'([{,])\s*"(?:[^"\\]|\\.)*"$', r'\1', repaired)
+        repaired = re.sub(r'[\s,]+$', '', repaired) + "".join(reversed(stack))
+    try: return json.loads(repaired, strict=False)
+    except json.JSONDecodeError as e: raise ValueError(f"JSON irréparable: {e}") from e
+
+@st.cache_resource
+def get_response_models():
+    """Schémas pydantic des réponses de chaque étape IA (import différé de pydantic)."""
+    from pydantic import BaseModel, field_validator
+
+    def _to_str(value): return "" if value is None else str(value)
+    def _to_str_list(value): return [str(v) for v in value if v is not None] if isinstance(value, list) else value
+    def _to_int(value):
+        try: return int(value) if value is not None else 0
+        except (ValueError, TypeError): return 0
+
+    class ContactModel(BaseModel):
+        email: str = ""
+        telephone: str = ""
+        linkedin: str = ""
+
+        @field_validator("email", "telephone", "linkedin", mode="before")
+        @classmethod
+        def coerce_str(cls, v): return _to_str(v)
+
+    class ScreeningModel(BaseModel):
+        nom: str
+        contact: ContactModel
+        langues: list[str]
+        diplome_principal: str
+        annees_experience_estimees: int
+
+        @field_validator("nom", "diplome_principal", mode="before")
+        @classmethod
+        def coerce_str(cls, v): return _to_str(v)
+
+        @field_validator("annees_experience_estimees", mode="before")
+        @classmethod
+        def coerce_int(cls, v): return _to_int(v)
+
+        @field_validator("contact", mode="before")
+        @classmethod
+        def coerce_contact(cls, v): return v if isinstance(v, dict) else {}
+
+        @field_validator("langues", mode="before")
+        @classmethod
+        def coerce_langues(cls, v): return _to_str_list(v) if isinstance(v, list) else []
+
+    class KeywordRefinementModel(BaseModel):
+        mots_cles_trouves_filtres: list[str]
+        mots_cles_manquants_prioritaires: list[str]
+
+        @field_validator("mots_cles_trouves_filtres", "mots_cles_manquants_prioritaires", mode="before")
+        @classmethod
+        def coerce_list(cls, v): return _to_str_list(v) # Une non-liste reste invalide
+
+        @field_validator("mots_cles_trouves_filtres", "mots_cles_manquants_prioritaires")
+        @classmethod
+        def limit(cls, v): return v[:10]
+
+    class QualitativeModel(BaseModel):
+        score: int
+        resume_profil: str
+        points_forts_cles: list[str]
+        points_faibles_risques: list[str]
+        adequation_poste: str
+        evaluation_technologies_cles: str
+
+        @field_validator("resume_profil", "adequation_poste", "evaluation_technologies_cles", mode="before")
+        @classmethod
+        def coerce_str(cls, v): return _to_str(v)
+
+        @field_validator("score", mode="before")
+        @classmethod
+        def clamp_score(cls, v): return max(0, min(_to_int(v), 100))
+
+        @field_validator("points_forts_cles", "points_faibles_risques", mode="before")
+        @classmethod
+        def coerce_list(cls, v): return _to_str_list(v) if isinstance(v, list) else []
+
+        @field_validator("points_forts_cles")
+        @classmethod
+        def limit_forts(cls, v): return v[:3]
+
+        @field_validator("points_faibles_risques")
+        @classmethod
+        def limit_faibles(cls, v): return v[:2]
+
+    return {"screening": ScreeningModel, "keywords": KeywordRefinementModel, "qualitative": QualitativeModel}
+
+def validate_stage_data(data, stage):
+    """Valide un objet déjà parsé contre le schéma de l'étape. Retourne un dict normalisé ou None."""
+    from pydantic import ValidationError
+    try: return get_response_models()[stage].model_validate(data).model_dump()
+    except ValidationError as e:
+        logger.warning(f"Réponse IA '{stage}' invalide ({e.error_count()} erreur(s)): {e.errors()[0]['loc']} {e.errors()[0]['msg']}")
+        return None
+
+def parse_stage_response(response_str, stage):
+    """Parse (avec réparation locale) puis valide une réponse IA brute. Retourne un dict ou None."""
+    try: data = repair_json(response_str)
+    except ValueError as e:
+        logger.warning(f"Réponse IA '{stage}' non JSON même après réparation ({e}): {response_str[:200]}...")
+        return None
+    return validate_stage_data(data, stage)
+
 # --- FONCTION D'APPEL API (OpenRouter UNIQUEMENT + retry + PAUSE 1.5s) ---
-@tenacity.retry(
-    wait=tenacity.wait_exponential(multiplier=2, min=3, max=30), 
-    stop=tenacity.stop_after_attempt(3),
-    # Ajouter InvalidSchema aux erreurs réessayables (au cas où, même si on corrige l'URL)
-    retry=tenacity.retry_if_exception_type((RequestException, IOError, HTTPError, ValueError, InvalidSchema)), 
-    before_sleep=tenacity.before_sleep_log(logger, logging.WARNING),
-    reraise=True
-)
-def call_openrouter_api(prompt, key_config, max_tokens=2000, temperature=0.1, force_json=False):
-    """Appelle l'API OpenRouter via requests, gère retries ET PAUSE de 1.5s."""
+@with_retry("openrouter")
+def call_openrouter_api(prompt, key_config, max_tokens=2000, temperature=0.1, force_json=False, usage_tag=None):
+    """Appelle l'API OpenRouter via requests, gère retries ET PAUSE de 1.5s.
+
+    La consommation de tokens est reportée (sous l'étiquette usage_tag) à l'ordonnanceur du lot en cours.
+    """
+    from requests.exceptions import HTTPError, InvalidSchema
     api_key = key_config["key"]
     model = key_config["model"]
     # --- CORRECTION URL ---
@@ -182,7 +911,7 @@ def call_openrouter_api(prompt, key_config, max_tokens=2000, temperature=0.1, fo
     try:
         # Log l'URL juste avant l'appel pour débogage
         logger.info(f"Appel POST vers: {url}")
-        response = requests.post(url, headers=headers, json=body, timeout=180)
+        response = get_http_session().post(url, headers=headers, json=body, timeout=180)
         
         # Log status code pour débogage même si ce n'est pas une erreur levée par raise_for_status
         logger.info(f"Réponse reçue de {url}: Status {response.status_code}")
@@ -190,6 +919,13 @@ def call_openrouter_api(prompt, key_config, max_tokens=2000, temperature=0.1, fo
         response.raise_for_status() # Lève HTTPError pour 4xx/5xx
         response_data = response.json()
 
+        # OpenRouter peut renvoyer un statut 200 avec une erreur du fournisseur dans le corps
+        if isinstance(response_data, dict) and isinstance(response_data.get('error'), dict):
+            error_code = response_data['error'].get('code')
+            error_msg = f"Erreur fournisseur ({error_code}): {str(response_data['error'].get('message', ''))[:200]}"
+            if is_retryable_status(error_code): raise ApiTransientError(error_msg)
+            raise ValueError(error_msg)
+
         if not isinstance(response_data, dict) or 'choices' not in response_data or not response_data['choices']:
             raise ValueError("Réponse API invalide: 'choices' manquantes ou vides.")
         
@@ -199,29 +935,78 @@ def call_openrouter_api(prompt, key_config, max_tokens=2000, temperature=0.1, fo
         
         if 'api_provider_logged' not in st.session_state:
              st.session_state.api_provider_logged = f"OpenRouter ({model})"
+
+        scheduler = st.session_state.get('batch_scheduler')
+        if scheduler:
+             usage = response_data.get('usage') if isinstance(response_data.get('usage'), dict) else {}
+             scheduler.record_usage(usage_tag, usage.get('total_tokens') or estimate_tokens(prompt) + estimate_tokens(content))
              
         time.sleep(1.5) # PAUSE après chaque appel réussi
         return content.strip()
 
     except InvalidSchema as e_schema: # Attraper spécifiquement l'erreur de schéma
          logger.error(f"ERREUR FATALE: InvalidSchema pour l'URL '{url}'. Vérifiez la définition de l'URL dans api_keys_pool. Erreur: {e_schema}")
-         # Ne pas réessayer sur cette erreur, c'est un bug de code
-         raise tenacity.DoAttempt # Indique à Tenacity d'arrêter les reessais pour cette cause
+         raise # Non réessayée (voir is_retryable_api_error) : c'est un bug de configuration
     except Exception as e:
         logger.error(f"Erreur appel API OpenRouter ({url}) : {e}")
         if isinstance(e, HTTPError):
             logger.error(f"Status Code: {e.response.status_code}, Response Body: {e.response.text[:500]}")
             if e.response.status_code == 400 and force_json:
                  logger.warning("Erreur 400 avec force_json=True. Modèle incompatible?")
-        time.sleep(2.0) 
-        raise # Relance pour Tenacity
+        if is_retryable_api_error(e): time.sleep(2.0) 
+        raise # Relance pour Tenacity (qui ne réessaie que les erreurs transport / 429 / 5xx)
 
 # --- ÉTAPE 1: Screening IA (JSON) ---
-# (Fonction inchangée, utilise call_openrouter_api corrigé)
-def call_screening_ia(cv_text, job_desc, key_config):
-    """Appelle l'IA pour extraire les infos structurées de base en JSON."""
+SCREENING_EXAMPLE = {
+    "nom": "Jean Dupont",
+    "contact": {"email": "jean.dupont@email.com", "telephone": "0612345678", "linkedin": "https://linkedin.com/in/jeandupont"},
+    "langues": ["Français (Natif)", "Anglais (C1)"],
+    "diplome_principal": "Master Informatique",
+    "annees_experience_estimees": 5,
+}
+SCREENING_KEY_TYPES = {"langues": " (liste de strings)", "diplome_principal": " (string)", "annees_experience_estimees": " (integer)"}
+
+def describe_screening_fields(requested_fields):
+    """Liste des clés attendues + exemple JSON, restreints aux champs demandés à l'IA.
+
+    Pour une demande partielle, les coordonnées de l'exemple sont vides : un champ n'est demandé
+    que s'il est introuvable localement, et une valeur d'exemple serait recopiée telle quelle.
+    """
+    partial = set(requested_fields) != set(LOCAL_PROFILE_FIELDS)
+    contact_keys = [field.split(".", 1)[1] for field in requested_fields if field.startswith("contact.")]
+    keys, example = [], {}
+    for field in LOCAL_PROFILE_FIELDS:
+        if field.startswith("contact."):
+            if "contact" in example or not contact_keys: continue
+            keys.append('"contact" (objet avec ' + ", ".join(f'"{key}"' for key in contact_keys) + ")")
+            example["contact"] = {key: "" if partial else SCREENING_EXAMPLE["contact"][key] for key in contact_keys}
+        elif field in requested_fields:
+            keys.append(f'"{field}"{SCREENING_KEY_TYPES.get(field, "")}')
+            example[field] = SCREENING_EXAMPLE[field]
+    return ", ".join(keys), example
+
+def complete_screening_data(data, local_profile, requested_fields):
+    """Complète une réponse IA partielle avec les champs locaux, puis valide le schéma du screening.
+
+    Retourne None si l'IA a omis une des clés demandées (comme une réponse incomplète sans extraction locale).
+    """
+    missing = {field.split(".", 1)[0] for field in requested_fields} - set(data if isinstance(data, dict) else ())
+    if missing:
+        logger.warning(f"Réponse IA 'screening' incomplète: clés manquantes {sorted(missing)}")
+        return None
+    if local_profile: data = merge_screening_data(local_profile, data, low_confidence_fields(local_profile))
+    return validate_stage_data(data, "screening")
+
+def call_screening_ia(cv_text, job_desc, key_config, local_profile=None):
+    """Appelle l'IA pour extraire les infos structurées de base en JSON.
+
+    Avec local_profile, seuls les champs à faible confiance locale sont demandés à l'IA.
+    """
+    requested_fields = low_confidence_fields(local_profile) if local_profile else LOCAL_PROFILE_FIELDS
+    keys_description, example = describe_screening_fields(requested_fields)
+    example_json = json.dumps(example, indent=2, ensure_ascii=False).replace("\n", "\n    ")
     prompt = f"""Extrais les informations suivantes du CV par rapport au poste.
-    Réponds OBLIGATOIREMENT en format JSON valide avec les clés exactes: "nom", "contact" (objet avec "email", "telephone", "linkedin"), "langues" (liste de strings), "diplome_principal" (string), "annees_experience_estimees" (integer).
+    Réponds OBLIGATOIREMENT en format JSON valide avec les clés exactes: {keys_description}.
     Si une info est absente, utilise null ou une valeur vide appropriée (liste vide, string vide, 0 pour expérience). NE PAS ajouter de commentaires ou texte hors JSON.
 
     DESCRIPTION POSTE (contexte rapide):
@@ -231,57 +1016,119 @@ def call_screening_ia(cv_text, job_desc, key_config):
     {cv_text[:4000]}
 
     JSON ATTENDU (exemple):
-    {{
-      "nom": "Jean Dupont",
-      "contact": {{
-        "email": "jean.dupont@email.com",
-        "telephone": "0612345678",
-        "linkedin": "https://linkedin.com/in/jeandupont" 
-      }},
-      "langues": ["Français (Natif)", "Anglais (C1)"],
-      "diplome_principal": "Master Informatique",
-      "annees_experience_estimees": 5
-    }}
+    {example_json}
 
     JSON:
     """
-    response_str = None 
     try:
-        response_str = call_openrouter_api(prompt, key_config, max_tokens=500, temperature=0.0, force_json=True)
-        
-        cleaned_json_string = response_str
-        if response_str.startswith("```json"): cleaned_json_string = response_str[7:-3].strip()
-        elif response_str.startswith("`"): cleaned_json_string = response_str.strip('`')
-        
-        try: data = json.loads(cleaned_json_string)
-        except json.JSONDecodeError:
-             logger.warning(f"Screening IA: tentative correction JSON...")
-             corrected_json_string = cleaned_json_string.replace('\\_', '_').replace('\\*', '*')
-             data = json.loads(corrected_json_string) 
-
-        required_keys = ["nom", "contact", "langues", "diplome_principal", "annees_experience_estimees"]
-        if all(key in data for key in required_keys):
-             data['contact'] = data.get('contact') if isinstance(data.get('contact'), dict) else {}
-             data['langues'] = data.get('langues') if isinstance(data.get('langues'), list) else []
-             data['diplome_principal'] = str(data.get('diplome_principal', '')) 
-             try:
-                 exp_val = data.get('annees_experience_estimees')
-                 data['annees_experience_estimees'] = int(exp_val) if exp_val is not None else 0
-             except (ValueError, TypeError): data['annees_experience_estimees'] = 0
-             return data
-        else:
-            logger.warning(f"Screening IA JSON incomplet: Clés manquantes dans {cleaned_json_string[:200]}...")
+        response_str = call_openrouter_api(prompt, key_config, max_tokens=500, temperature=0.0, force_json=True, usage_tag="screening")
+        try: data = repair_json(response_str)
+        except ValueError as e:
+            logger.warning(f"Réponse IA 'screening' non JSON même après réparation ({e}): {response_str[:200]}...")
             return None
-            
-    except json.JSONDecodeError:
-        logger.warning(f"Screening IA réponse non JSON (après nettoyage): {cleaned_json_string[:200]}...")
+        return complete_screening_data(data, local_profile, requested_fields)
+    except Exception as e:
+        logger.error(f"Erreur appel Screening IA: {e}") 
         return None
+
+# --- ÉTAPE 1 (mode groupé): Screening de plusieurs CV en un seul appel ---
+SCREENING_BATCH_TOKEN_BUDGET = 6000 # Tokens de prompt max par requête groupée
+SCREENING_BATCH_MAX_CVS = 6         # k max de CV par requête
+SCREENING_BATCH_CV_CHARS = 4000     # Même troncature que le screening unitaire
+SCREENING_TOKENS_PER_CV_OUTPUT = 180 # Réponse JSON attendue par CV (pour max_tokens)
+
+def estimate_tokens(text):
+    """Estimation grossière (~4 caractères par token), suffisante pour dimensionner les lots."""
+    return len(text) // 4 + 1
+
+def plan_screening_batches(cv_items, token_budget=SCREENING_BATCH_TOKEN_BUDGET, max_cvs=SCREENING_BATCH_MAX_CVS):
+    """Découpe [(cv_id, cv_text)] en lots dont le prompt estimé tient dans token_budget."""
+    batches, current, current_tokens = [], [], 0
+    for cv_id, cv_text in cv_items:
+        cv_tokens = estimate_tokens(cv_text[:SCREENING_BATCH_CV_CHARS]) + 20 # + balises du CV
+        if current and (current_tokens + cv_tokens > token_budget or len(current) >= max_cvs):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append((cv_id, cv_text))
+        current_tokens += cv_tokens
+    if current: batches.append(current)
+    return batches
+
+def call_screening_batch_ia(batch, job_desc, key_config, local_profiles=None):
+    """Screening de k CV en une requête. Retourne {cv_id: données validées} pour les CV réussis uniquement.
+
+    Avec local_profiles ({cv_id: profil local}), seuls les champs à faible confiance dans au moins un CV sont demandés.
+    """
+    local_profiles = local_profiles or {}
+    low_fields = set()
+    for cv_id, _ in batch:
+        low_fields.update(low_confidence_fields(local_profiles[cv_id]) if cv_id in local_profiles else LOCAL_PROFILE_FIELDS)
+    requested_fields = [field for field in LOCAL_PROFILE_FIELDS if field in low_fields]
+    keys_description, example = describe_screening_fields(requested_fields)
+    example_items = ",\n        ".join(json.dumps({"cv_id": f"cv_{n}", **example}, ensure_ascii=False) for n in range(2))
+    cv_blocks = "\n\n".join(
+        f'=== DÉBUT CV id="{cv_id}" ===\n{cv_text[:SCREENING_BATCH_CV_CHARS]}\n=== FIN CV id="{cv_id}" ==='
+        for cv_id, cv_text in batch
+    )
+    prompt = f"""Extrais les informations suivantes pour CHACUN des {len(batch)} CV ci-dessous, par rapport au poste.
+    Réponds OBLIGATOIREMENT en format JSON valide: un objet avec la clé "resultats" contenant une liste, avec exactement un élément par CV.
+    Chaque élément a les clés exactes: "cv_id" (l'id du CV, recopié à l'identique), {keys_description}.
+    Si une info est absente, utilise null ou une valeur vide appropriée (liste vide, string vide, 0 pour expérience). NE PAS mélanger les informations de CV différents. NE PAS ajouter de commentaires ou texte hors JSON.
+
+    DESCRIPTION POSTE (contexte rapide):
+    {job_desc[:1000]}
+
+    CV À ANALYSER:
+    {cv_blocks}
+
+    JSON ATTENDU (exemple pour 2 CV):
+    {{
+      "resultats": [
+        {example_items}
+      ]
+    }}
+
+    JSON:
+    """
+    results = {}
+    expected_ids = {cv_id for cv_id, _ in batch}
+    try:
+        response_str = call_openrouter_api(prompt, key_config, max_tokens=SCREENING_TOKENS_PER_CV_OUTPUT * len(batch) + 100, temperature=0.0, force_json=True, usage_tag="screening_batch")
+        data = repair_json(response_str)
+        # Tableau JSON direct ou objet {"resultats": [...]} (json_object impose un objet)
+        items = data.get("resultats", []) if isinstance(data, dict) else data
+        if not isinstance(items, list):
+            logger.warning(f"Screening groupé: 'resultats' n'est pas une liste: {response_str[:200]}...")
+            return results
+        # Chaque élément est validé indépendamment : un élément invalide n'invalide pas le lot
+        for item in items:
+            cv_id = str(item.get("cv_id")) if isinstance(item, dict) else None
+            if cv_id not in expected_ids or cv_id in results:
+                continue
+            validated = complete_screening_data(item, local_profiles.get(cv_id), requested_fields)
+            if validated: results[cv_id] = validated
+            else: logger.warning(f"Screening groupé: élément invalide pour {cv_id}.")
+    except ValueError as e:
+        logger.warning(f"Screening groupé réponse non JSON même après réparation: {e}")
     except Exception as e:
-        logger.error(f"Erreur appel/parsing Screening IA: {e}") 
-        return None 
+        logger.error(f"Erreur appel Screening groupé IA: {e}")
+    return results
+
+def run_batched_screening(cv_items, job_desc, api_keys_pool, local_profiles=None):
+    """Screening groupé de tous les CV. Les CV absents du résultat seront re-traités en appel unitaire."""
+    screening_by_id = {}
+    batches = plan_screening_batches(cv_items)
+    for batch_index, batch in enumerate(batches):
+        st.write(f"📦 Screening groupé {batch_index + 1}/{len(batches)} ({len(batch)} CV)...")
+        key_config = api_keys_pool[batch_index % len(api_keys_pool)]
+        batch_results = call_screening_batch_ia(batch, job_desc, key_config, local_profiles)
+        screening_by_id.update(batch_results)
+        if len(batch_results) < len(batch):
+            logger.warning(f"Screening groupé {batch_index + 1}: {len(batch) - len(batch_results)} CV à re-traiter individuellement.")
+    return screening_by_id
 
 # --- ÉTAPE 2b: Raffinement Mots-Clés IA (JSON) ---
-# (Fonction inchangée, utilise call_openrouter_api corrigé)
+# (Réponse parsée et validée par parse_stage_response)
 def call_keyword_refinement_ia(mots_cles_trouves_bruts, mots_cles_manquants_bruts, cv_extrait, job_desc_extrait, key_config):
     """Demande à l'IA de filtrer et prioriser les listes de mots-clés brutes."""
     if not mots_cles_trouves_bruts and not mots_cles_manquants_bruts: return None 
@@ -313,38 +1160,15 @@ def call_keyword_refinement_ia(mots_cles_trouves_bruts, mots_cles_manquants_brut
 
     JSON:
     """
-    response_str = None 
     try:
-        response_str = call_openrouter_api(prompt, key_config, max_tokens=400, temperature=0.1, force_json=True)
-        
-        cleaned_json_string = response_str
-        if response_str.startswith("```json"): cleaned_json_string = response_str[7:-3].strip()
-        elif response_str.startswith("`"): cleaned_json_string = response_str.strip('`')
-
-        try: data = json.loads(cleaned_json_string)
-        except json.JSONDecodeError:
-             logger.warning(f"Raffinement Mots-clés: tentative correction JSON...")
-             corrected_json_string = cleaned_json_string.replace('\\_', '_').replace('\\*', '*')
-             data = json.loads(corrected_json_string)
-
-        required_keys = ["mots_cles_trouves_filtres", "mots_cles_manquants_prioritaires"]
-        if all(key in data for key in required_keys) and isinstance(data["mots_cles_trouves_filtres"], list) and isinstance(data["mots_cles_manquants_prioritaires"], list):
-            data["mots_cles_trouves_filtres"] = data["mots_cles_trouves_filtres"][:10]
-            data["mots_cles_manquants_prioritaires"] = data["mots_cles_manquants_prioritaires"][:10]
-            return data
-        else:
-            logger.warning(f"Raffinement Mots-clés JSON incomplet: {cleaned_json_string[:200]}...")
-            return None
-            
-    except json.JSONDecodeError:
-        logger.warning(f"Raffinement Mots-clés réponse non JSON (après nettoyage): {cleaned_json_string[:200]}...")
-        return None
+        response_str = call_openrouter_api(prompt, key_config, max_tokens=400, temperature=0.1, force_json=True, usage_tag="keywords")
+        return parse_stage_response(response_str, "keywords")
     except Exception as e:
-        logger.error(f"Erreur appel/parsing Raffinement Mots-clés IA: {e}")
+        logger.error(f"Erreur appel Raffinement Mots-clés IA: {e}") 
         return None
 
 # --- ÉTAPE 3: Analyse Qualitative IA (JSON) ---
-# (Fonction inchangée, utilise call_openrouter_api corrigé)
+# (Réponse parsée et validée par parse_stage_response)
 def call_qualitative_ia(cv_text, job_desc, screening_data, key_config):
     """Demande l'analyse qualitative (score, résumé, forces/faiblesses)."""
     screening_info_str = json.dumps(screening_data, indent=2, ensure_ascii=False) if screening_data else "Non disponible (Étape 1 échouée)"
@@ -384,59 +1208,18 @@ def call_qualitative_ia(cv_text, job_desc, screening_data, key_config):
 
     JSON:
     """
-    response_str = None 
     try:
-        response_str = call_openrouter_api(prompt, key_config, max_tokens=1000, temperature=0.2, force_json=True) # Augmenté max_tokens
-        
-        cleaned_json_string = response_str
-        if response_str.startswith("```json"): cleaned_json_string = response_str[7:-3].strip()
-        elif response_str.startswith("`"): cleaned_json_string = response_str.strip('`')
-
-        try: data = json.loads(cleaned_json_string)
-        except json.JSONDecodeError:
-             logger.warning(f"Analyse Qualitative: tentative correction JSON...")
-             corrected_json_string = cleaned_json_string.replace('\\_', '_').replace('\\*', '*')
-             data = json.loads(corrected_json_string)
-
-        # AJOUT DE LA NOUVELLE CLÉ REQUISE
-        required_keys = ["score", "resume_profil", "points_forts_cles", "points_faibles_risques", "adequation_poste", "evaluation_technologies_cles"]
-        if all(key in data for key in required_keys):
-             try: 
-                 score_val = int(data.get('score', 0))
-                 data['score'] = max(0, min(score_val, 100))
-             except: data['score'] = 0
-             data['resume_profil'] = str(data.get('resume_profil', '')) 
-             data['points_forts_cles'] = data.get('points_forts_cles', []) if isinstance(data.get('points_forts_cles'), list) else []
-             data['points_faibles_risques'] = data.get('points_faibles_risques', []) if isinstance(data.get('points_faibles_risques'), list) else []
-             data['adequation_poste'] = str(data.get('adequation_poste', ''))
-             # PARSING DE LA NOUVELLE CLÉ
-             data['evaluation_technologies_cles'] = str(data.get('evaluation_technologies_cles', ''))
-             
-             data['points_forts_cles'] = data['points_forts_cles'][:3]
-             data['points_faibles_risques'] = data['points_faibles_risques'][:2]
-             return data
-        else:
-            logger.warning(f"Analyse Qualitative JSON incomplet: Clés manquantes (dont 'evaluation_technologies_cles'?) dans {cleaned_json_string[:200]}...")
-            return None
-            
-    except json.JSONDecodeError:
-        logger.warning(f"Analyse Qualitative réponse non JSON (après nettoyage): {cleaned_json_string[:200]}...")
-        return None
+        response_str = call_openrouter_api(prompt, key_config, max_tokens=1000, temperature=0.2, force_json=True, usage_tag="qualitative") # Augmenté max_tokens
+        return parse_stage_response(response_str, "qualitative")
     except Exception as e:
-        logger.error(f"Erreur appel/parsing Analyse Qualitative IA: {e}")
+        logger.error(f"Erreur appel Analyse Qualitative IA: {e}") 
         return None
 
 # --- ÉTAPE 4: Recherche Web (Locale) ---
-@tenacity.retry(
-    wait=tenacity.wait_exponential(multiplier=2, min=2, max=20), 
-    stop=tenacity.stop_after_attempt(3),
-    # Nous réessayons sur n'importe quelle Exception générique, 
-    # car DDGS peut lever des erreurs variées (y compris non-HTTP) pour un ratelimit.
-    retry=tenacity.retry_if_exception_type(Exception), 
-    reraise=True
-)
+@with_retry("web_search")
 def perform_web_search(candidate_name, linkedin_url):
     """Effectue une recherche web simple et retourne les 3 premiers liens pertinents."""
+    from duckduckgo_search import DDGS # Import différé : uniquement si une recherche web a lieu
     links = []
     if not candidate_name or "Basique)" in candidate_name or "Erreur" in candidate_name or "Manquant" in candidate_name:
         return links 
@@ -476,6 +1259,396 @@ def perform_web_search(candidate_name, linkedin_url):
     
     return links
 
+# --- GRAPHE D'ÉTAPES PAR CV (exécution concurrente) ---
+# Dépendances entre les étapes IA d'un même CV. Le raffinement des mots-clés (2b, clé 2) ne dépend
+# que de l'analyse locale ; la recherche web n'a besoin que du nom (étape 1) et tourne en parallèle
+# de l'analyse qualitative (étape 3, clé 1). La latence d'un CV devient celle du chemin critique.
+STAGE_DEPENDENCIES = {"screening": (), "keywords": (), "qualitative": ("screening",), "web": ("screening",)}
+
+def critical_path_seconds(stage_seconds):
+    """Durée du chemin critique d'un ensemble d'étapes {étape: secondes} (dépendances de STAGE_DEPENDENCIES)."""
+    finish = {}
+    def finish_time(stage):
+        if stage not in finish:
+            deps = [dep for dep in STAGE_DEPENDENCIES.get(stage, ()) if dep in stage_seconds]
+            finish[stage] = stage_seconds[stage] + max((finish_time(dep) for dep in deps), default=0.0)
+        return finish[stage]
+    return max((finish_time(stage) for stage in stage_seconds), default=0.0)
+
+def run_stage_graph(graph, executor):
+    """Exécute un graphe {étape: (dépendances, fonction(résultats))} avec un maximum de recouvrement.
+
+    Une étape est soumise à `executor` dès que ses dépendances présentes dans le graphe sont terminées ;
+    sa fonction reçoit leurs résultats (None pour une dépendance en échec). Le générateur rend
+    (étape, future) dans l'ordre de fin : l'appelant traite chaque résultat dans son thread (UI,
+    fusion dans le résultat final) avant que les étapes qui en dépendent ne soient soumises.
+    """
+    order = {stage: rank for rank, stage in enumerate(graph)}
+    results, waiting, running = {}, dict(graph), {}
+    while waiting or running:
+        for stage, (deps, fn) in list(waiting.items()):
+            if all(dep in results for dep in deps if dep in graph):
+                del waiting[stage]
+                running[executor.submit(fn, {dep: results.get(dep) for dep in deps})] = stage
+        if not running: raise ValueError(f"Dépendances circulaires entre étapes : {sorted(waiting)}")
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in sorted(done, key=lambda f: order[running[f]]):
+            stage = running.pop(future)
+            yield stage, future
+            results[stage] = None if future.exception() else future.result()
+
+def run_timed_stage(scheduler, stage, fn, *args):
+    """Exécute une étape en la chronométrant pour l'ordonnanceur (succès uniquement) et en la profilant."""
+    stage_start = time.time()
+    with profiled_stage(stage):
+        result = fn(*args)
+    scheduler.record_stage_time(stage, time.time() - stage_start)
+    return result
+
+def get_stage_executor():
+    """Pool de threads des étapes d'un CV ; les threads héritent du contexte Streamlit du run (st.*, session_state).
+
+    En mode profilage, un seul worker : les étapes passent en série pour que chacune ait sa propre
+    fenêtre tracemalloc (allocations attribuées par étape, au prix de la latence).
+    """
+    profiler = st.session_state.get("profiler")
+    max_workers = 1 if profiler is not None and profiler.running else len(STAGE_DEPENDENCIES)
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rhplus-etape",
+                              initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx()))
+
+# --- ORDONNANCEUR DE LOT (budget tokens + délai) ---
+class BatchScheduler:
+    """Décide, CV par CV, quelles étapes IA lancer avec le budget de tokens et le délai restants.
+
+    Les CV sont traités par pré-score local décroissant : quand le budget s'épuise, ce sont les
+    profils les moins prometteurs qui passent en analyse locale. Les coûts (tokens) et durées de
+    chaque étape sont estimés a priori puis recalés sur les appels réellement observés.
+    """
+    # Étapes par ordre de priorité (l'analyse qualitative nécessite le screening)
+    STAGE_PRIORITY = ("screening", "qualitative", "keywords", "web")
+    # (car. poste, car. CV, tokens du gabarit de prompt, tokens de réponse typiques)
+    STAGE_PROMPT_SPECS = {"screening": (1000, 4000, 350, 150), "keywords": (1000, 2000, 400, 150), "qualitative": (1500, 5000, 750, 400)}
+    DEFAULT_STAGE_SECONDS = {"screening": 6.0, "keywords": 5.0, "qualitative": 10.0, "web": 4.0, "screening_batch": 15.0}
+    LOCAL_CV_SECONDS = 0.5   # Analyse locale seule (extraction déjà faite)
+    CV_PAUSE_SECONDS = 3.0   # Pause entre CV quand des appels IA ont eu lieu
+
+    def __init__(self, token_budget=0, deadline_seconds=0):
+        self.start_time = time.time()
+        self.token_budget = int(token_budget) or None
+        self.deadline = self.start_time + deadline_seconds if deadline_seconds else None
+        self.tokens_used = 0
+        self._stage_tokens = {}   # étape -> [total tokens, nb appels]
+        self._stage_seconds = {}  # étape -> [total secondes, nb appels]
+        self._cv_seconds = []
+        self._lock = threading.Lock()
+
+    # --- Mesures ---
+    def record_usage(self, stage, tokens):
+        with self._lock:
+            self.tokens_used += tokens
+            if stage:
+                totals = self._stage_tokens.setdefault(stage, [0, 0])
+                totals[0] += tokens; totals[1] += 1
+
+    def record_stage_time(self, stage, seconds):
+        with self._lock:
+            totals = self._stage_seconds.setdefault(stage, [0.0, 0])
+            totals[0] += seconds; totals[1] += 1
+
+    def record_cv_time(self, seconds):
+        with self._lock: self._cv_seconds.append(seconds)
+
+    # --- Estimations ---
+    def estimate_stage_tokens(self, stage, cv_text, job_desc):
+        if stage not in self.STAGE_PROMPT_SPECS: return 0
+        observed = self._stage_tokens.get(stage)
+        if observed and observed[1]: return observed[0] / observed[1]
+        job_chars, cv_chars, template_tokens, output_tokens = self.STAGE_PROMPT_SPECS[stage]
+        return estimate_tokens(job_desc[:job_chars]) + estimate_tokens(cv_text[:cv_chars]) + template_tokens + output_tokens
+
+    def estimate_stage_seconds(self, stage):
+        observed = self._stage_seconds.get(stage)
+        if observed and observed[1]: return observed[0] / observed[1]
+        return self.DEFAULT_STAGE_SECONDS.get(stage, 5.0)
+
+    def tokens_left(self):
+        return float("inf") if self.token_budget is None else self.token_budget - self.tokens_used
+
+    def seconds_left(self):
+        return float("inf") if self.deadline is None else self.deadline - time.time()
+
+    # --- Décisions ---
+    @staticmethod
+    def prescore(cv_text, job_keywords):
+        """Pré-score local peu coûteux : part des mots-clés du poste présents dans le CV."""
+        if not cv_text or not job_keywords: return 0.0
+        return len(job_keywords.intersection(RX["mot_cle"].findall(cv_text.lower()))) / len(job_keywords)
+
+    def order_by_prescore(self, cv_texts, job_desc):
+        """Indices des CV triés par pré-score décroissant (CV illisibles en dernier)."""
+        job_keywords = set(RX["mot_cle"].findall(job_desc.lower()))
+        scores = [self.prescore(cv_text, job_keywords) for cv_text in cv_texts]
+        return sorted(range(len(cv_texts)), key=lambda i: (bool(cv_texts[i]), scores[i]), reverse=True)
+
+    def select_for_batched_screening(self, cv_items, job_desc):
+        """CV à inclure dans le screening groupé, parmi `cv_items` = [(cv_id, cv_text, besoin_screening)] par pré-score décroissant.
+
+        Chaque CV parcouru réserve son screening (s'il en a besoin) ET son analyse qualitative : un CV
+        n'est retenu que si les deux tiennent encore dans les tokens et le délai, pour que les CV moins
+        prometteurs ne consomment pas le budget de l'étape 3 des meilleurs. Le parcours s'arrête au premier
+        CV qui ne tient plus (les suivants relèvent de plan_stages, CV par CV).
+        """
+        selected, tokens, seconds = [], 0, 0.0
+        tokens_left, seconds_left = self.tokens_left(), self.seconds_left()
+        for walked, (cv_id, cv_text, needs_screening) in enumerate(cv_items, start=1):
+            cv_tokens = self.estimate_stage_tokens("qualitative", cv_text, job_desc)
+            if needs_screening: cv_tokens += self.estimate_stage_tokens("screening", cv_text, job_desc)
+            cv_seconds = self.estimate_stage_seconds("qualitative") + self.CV_PAUSE_SECONDS
+            batches = (len(selected) + needs_screening - 1) // SCREENING_BATCH_MAX_CVS + 1
+            total_seconds = (batches * self.estimate_stage_seconds("screening_batch") + seconds + cv_seconds
+                             + (len(cv_items) - walked) * self.LOCAL_CV_SECONDS)
+            if tokens + cv_tokens > tokens_left or total_seconds > seconds_left:
+                break
+            tokens += cv_tokens; seconds += cv_seconds
+            if needs_screening: selected.append((cv_id, cv_text))
+        return selected
+
+    def plan_stages(self, cv_text, job_desc, cvs_remaining_after, screening_done=False):
+        """Étapes à lancer pour ce CV, par priorité, tant qu'elles tiennent dans le budget restant.
+
+        Le temps réservé aux CV suivants (analyse locale au minimum) est déduit du délai restant.
+        Les étapes d'un CV tournant en parallèle, seul leur chemin critique doit tenir dans le délai.
+        """
+        tokens_left = self.tokens_left()
+        seconds_left = self.seconds_left() - cvs_remaining_after * self.LOCAL_CV_SECONDS - self.CV_PAUSE_SECONDS
+        planned = {}  # étape -> secondes estimées
+        for stage in self.STAGE_PRIORITY:
+            if stage == "screening" and screening_done:
+                planned[stage] = 0.0; continue
+            if stage == "qualitative" and "screening" not in planned: continue
+            stage_tokens = self.estimate_stage_tokens(stage, cv_text, job_desc)
+            stage_seconds = self.estimate_stage_seconds(stage)
+            if (stage_tokens == 0 or stage_tokens <= tokens_left) and critical_path_seconds({**planned, stage: stage_seconds}) <= seconds_left:
+                planned[stage] = stage_seconds
+                tokens_left -= stage_tokens
+        return set(planned)
+
+    # --- Reporting ---
+    def progress_suffix(self, cvs_done, cvs_total):
+        """Texte 'fin estimée' + consommation de tokens pour la barre de progression."""
+        parts = []
+        cvs_left = cvs_total - cvs_done
+        if self._cv_seconds and cvs_left > 0:
+            eta = cvs_left * sum(self._cv_seconds) / len(self._cv_seconds)
+            parts.append(f"fin estimée dans ~{eta:.0f}s ({time.strftime('%H:%M:%S', time.localtime(time.time() + eta))})")
+        if self.token_budget is not None: parts.append(f"{self.tokens_used}/{self.token_budget} tokens")
+        elif self.tokens_used: parts.append(f"{self.tokens_used} tokens")
+        if self.deadline is not None: parts.append(f"{max(self.seconds_left(), 0):.0f}s restantes")
+        return " | ".join(parts)
+
+# --- PROFILAGE CPU / MÉMOIRE (mode opt-in) ---
+class RunProfiler:
+    """Profileur d'une analyse complète, sans outil externe.
+
+    - CPU : un thread échantillonne toutes les `interval` secondes les piles des threads
+      enregistrés (sys._current_frames). Chaque pile est préfixée par l'étape en cours,
+      l'export au format speedscope (https://www.speedscope.app) donne donc un flamegraph par étape.
+    - Mémoire : les traces tracemalloc sont remises à zéro à l'ouverture d'une « fenêtre »
+      (première étape active) ; à sa fermeture, les allocations encore vivantes et le pic sont
+      attribués par ligne de code. Un instantané ne porte ainsi que sur la fenêtre, pas sur tout
+      le processus. Des étapes qui se chevauchent (threads) partagent la même fenêtre.
+    Les allocations du profileur lui-même et les threads en attente (verrou, worker du pool sans
+    tâche) sont exclus des classements et rapportés à part.
+    """
+    STAGE_FRAME_PREFIX = "[étape] "
+    IGNORED_ALLOCATION_PREFIXES = ("<frozen importlib", "<unknown>")
+    # Sommets de pile d'un thread bloqué : attente d'une condition (future, verrou) ou worker inactif
+    IDLE_CODES = frozenset({threading.Condition.wait.__code__, concurrent.futures.thread._worker.__code__})
+
+    def __init__(self, interval=PROFILING_SAMPLE_INTERVAL, top_n=PROFILING_TOP_ALLOCATIONS):
+        self.interval = interval
+        self.top_n = top_n
+        self.running = False
+        self.duration = 0.0
+        self.peak_bytes = 0
+        self.overhead_seconds = 0.0 # Temps passé dans les instantanés tracemalloc
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._sampler = None
+        self._threads = {}        # ident -> nom du thread échantillonné
+        self._stage_stack = {}    # ident -> pile des étapes en cours
+        self._frames, self._frame_index = [], {}
+        self._stacks, self._stack_index = [], {} # piles distinctes (indices racine -> feuille)
+        self._samples = {}        # ident -> ([indice de pile], [poids en s])
+        self._idle_seconds = {}   # ident -> secondes passées en attente
+        self._stage_times = {}    # étape -> [appels, secondes]
+        self._window_active, self._window_names = [], set()
+        self._memory_stats = {}   # étape(s) de la fenêtre -> {"fenetres", "octets", "pic", "lignes": {ligne: [octets, blocs]}}
+        # Lignes du profileur qui allouent pendant les étapes (échantillons) : exclues des allocations
+        self._own_lines = {(code.co_filename, line) for code in (RunProfiler._sample_loop.__code__, RunProfiler._frame_id.__code__)
+                           for _, _, line in code.co_lines() if line}
+
+    def start(self):
+        """Démarre l'échantillonnage et tracemalloc ; peut reprendre un profileur arrêté (export à la demande)."""
+        tracemalloc.start()
+        self.register_thread()
+        self._start_time = time.perf_counter()
+        self._stop_event.clear()
+        self.running = True
+        self._sampler = threading.Thread(target=self._sample_loop, name="rhplus-profiler", daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        if not self.running: return
+        self._stop_event.set()
+        self._sampler.join()
+        self.duration += time.perf_counter() - self._start_time
+        self.peak_bytes = max(self.peak_bytes, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        self.running = False
+
+    def register_thread(self):
+        """Ajoute le thread courant aux threads échantillonnés (thread du script ou worker)."""
+        with self._lock:
+            self._threads.setdefault(threading.get_ident(), threading.current_thread().name)
+
+    # --- Échantillonnage CPU ---
+    def _frame_id(self, name, file="", line=0):
+        key = (name, file, line)
+        index = self._frame_index.get(key)
+        if index is None:
+            index = self._frame_index[key] = len(self._frames)
+            self._frames.append({"name": name, "file": file, "line": line})
+        return index
+
+    def _sample_loop(self):
+        last = time.perf_counter()
+        while not self._stop_event.wait(self.interval):
+            now = time.perf_counter()
+            weight, last = now - last, now
+            current_frames = sys._current_frames()
+            with self._lock:
+                for ident in self._threads:
+                    frame = current_frames.get(ident)
+                    if frame is None: continue
+                    if frame.f_code in self.IDLE_CODES:
+                        self._idle_seconds[ident] = self._idle_seconds.get(ident, 0.0) + weight
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(self._frame_id(code.co_name, code.co_filename, code.co_firstlineno))
+                        frame = frame.f_back
+                    stages = self._stage_stack.get(ident)
+                    if stages: stack.append(self._frame_id(self.STAGE_FRAME_PREFIX + stages[-1]))
+                    stack = tuple(reversed(stack))
+                    stack_id = self._stack_index.get(stack)
+                    if stack_id is None:
+                        stack_id = self._stack_index[stack] = len(self._stacks)
+                        self._stacks.append(stack)
+                    stack_ids, weights = self._samples.setdefault(ident, ([], []))
+                    stack_ids.append(stack_id); weights.append(weight)
+
+    # --- Étapes (temps + allocations) ---
+    @contextlib.contextmanager
+    def stage(self, name):
+        ident = threading.get_ident()
+        self.register_thread()
+        with self._lock:
+            self._stage_stack.setdefault(ident, []).append(name)
+            if not self._window_active: tracemalloc.clear_traces() # Nouvelle fenêtre mémoire
+            self._window_active.append(name)
+            self._window_names.add(name)
+        stage_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - stage_start
+            with self._lock:
+                self._stage_stack[ident].pop()
+                timing = self._stage_times.setdefault(name, [0, 0.0])
+                timing[0] += 1; timing[1] += elapsed
+                self._window_active.remove(name)
+                if not self._window_active: self._close_memory_window()
+
+    def _close_memory_window(self):
+        """Attribue les allocations encore vivantes de la fenêtre aux étapes qui l'ont ouverte (verrou tenu)."""
+        close_start = time.perf_counter()
+        label = " + ".join(sorted(self._window_names))
+        self._window_names = set()
+        peak = tracemalloc.get_traced_memory()[1] # Inclut les échantillons du profileur (pas de filtre possible)
+        self.peak_bytes = max(self.peak_bytes, peak)
+        stats = self._memory_stats.setdefault(label, {"fenetres": 0, "octets": 0, "pic": 0, "lignes": {}})
+        stats["fenetres"] += 1; stats["pic"] = max(stats["pic"], peak)
+        for stat in tracemalloc.take_snapshot().statistics("lineno"):
+            location = stat.traceback[0]
+            if location.filename.startswith(self.IGNORED_ALLOCATION_PREFIXES) or location.filename == tracemalloc.__file__: continue
+            if (location.filename, location.lineno) in self._own_lines: continue
+            stats["octets"] += stat.size
+            line = stats["lignes"].setdefault(str(location), [0, 0])
+            line[0] += stat.size; line[1] += stat.count
+        self.overhead_seconds += time.perf_counter() - close_start
+
+    # --- Rapports ---
+    def to_speedscope(self):
+        """Profil CPU au format speedscope (un profil 'sampled' par thread), en octets JSON."""
+        with self._lock:
+            profiles = [{
+                "type": "sampled", "name": self._threads.get(ident, str(ident)), "unit": "seconds",
+                "startValue": 0, "endValue": sum(weights), "samples": [self._stacks[stack_id] for stack_id in stack_ids], "weights": weights,
+            } for ident, (stack_ids, weights) in self._samples.items()]
+            document = {
+                "$schema": "https://www.speedscope.app/file-format-schema.json",
+                "name": f"RH+ Pro - analyse ({self.duration:.1f}s)", "exporter": "rhplus-run-profiler",
+                "shared": {"frames": list(self._frames)}, "profiles": profiles,
+            }
+        return json.dumps(document, ensure_ascii=False).encode("utf-8")
+
+    def hot_functions(self, limit=15):
+        """Fonctions les plus présentes en sommet de pile (temps propre, attentes exclues), en secondes."""
+        self_time = {}
+        with self._lock:
+            for stack_ids, weights in self._samples.values():
+                for stack_id, weight in zip(stack_ids, weights):
+                    leaf = self._stacks[stack_id][-1]
+                    self_time[leaf] = self_time.get(leaf, 0.0) + weight
+            frames = list(self._frames)
+        ranked = sorted(self_time.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(frames[index], seconds) for index, seconds in ranked]
+
+    def allocation_report(self):
+        """Rapport texte : temps propre par fonction, durée par étape, puis top des allocations par étape."""
+        lines = [f"Durée profilée : {self.duration:.2f}s (dont {self.overhead_seconds:.2f}s d'instantanés mémoire, "
+                 f"attribués à RunProfiler.stage) | pic mémoire d'une étape : {self.peak_bytes / 1e6:.1f} Mo",
+                 "Étapes d'un CV exécutées en série pendant le profilage (latences non représentatives du mode parallèle).", ""]
+        lines.append("== Temps propre par fonction (échantillonnage) ==")
+        for frame, seconds in self.hot_functions():
+            location = f"{os.path.basename(frame['file'])}:{frame['line']}" if frame["file"] else ""
+            lines.append(f"{seconds:8.3f}s  {frame['name']}  {location}")
+        with self._lock:
+            stage_times = sorted(self._stage_times.items(), key=lambda item: item[1][1], reverse=True)
+            memory_stats = sorted(self._memory_stats.items(), key=lambda item: item[1]["pic"], reverse=True)
+            idle = [(self._threads.get(ident, str(ident)), seconds) for ident, seconds in self._idle_seconds.items()]
+        lines += ["", "== Attente (thread bloqué ou worker sans tâche, exclue du temps propre et du flamegraph) =="]
+        for thread_name, seconds in sorted(idle, key=lambda item: item[1], reverse=True):
+            lines.append(f"{seconds:8.3f}s  {thread_name}")
+        lines += ["", "== Durée par étape =="]
+        for name, (calls, seconds) in stage_times:
+            lines.append(f"{seconds:8.3f}s  {name} ({calls} appel(s))")
+        for label, stats in memory_stats:
+            lines += ["", f"== Allocations {label} : {stats['fenetres']} fois, pic {stats['pic'] / 1024:.1f} Kio, "
+                          f"{stats['octets'] / 1024:.1f} Kio encore alloués en fin d'étape =="]
+            top_lines = sorted(stats["lignes"].items(), key=lambda item: item[1][0], reverse=True)[:self.top_n]
+            for location, (size, count) in top_lines:
+                lines.append(f"{size / 1024:10.1f} Kio  {count:6d} blocs  {location}")
+        return "\n".join(lines)
+
+def profiled_stage(name):
+    """Contexte de profilage d'une étape ; sans effet si le mode profilage est désactivé."""
+    profiler = st.session_state.get("profiler")
+    if profiler is None or not profiler.running: return contextlib.nullcontext()
+    return profiler.stage(name)
+
 # --- INTERFACE UTILISATEUR (UI) ---
 # (Identique)
 with st.sidebar:
@@ -500,6 +1673,28 @@ with st.sidebar:
         label="Chargez un ou plusieurs CV au format PDF", type="pdf",
         accept_multiple_files=True, disabled=st.session_state.is_running
     )
+    st.header("3. Options")
+    batch_screening = st.toggle(
+        "Screening groupé (plusieurs CV par appel IA)", value=True,
+        disabled=st.session_state.is_running,
+        help="Regroupe plusieurs CV dans une seule requête de screening (Étape 1). Les CV en échec sont re-traités un par un."
+    )
+    token_budget = st.number_input(
+        "Budget tokens du lot (0 = illimité)", min_value=0, value=0, step=10000,
+        disabled=st.session_state.is_running,
+        help="Au-delà, les CV restants (les moins pertinents d'après un pré-score local) passent en analyse locale."
+    )
+    deadline_minutes = st.number_input(
+        "Délai max du lot en minutes (0 = illimité)", min_value=0.0, value=0.0, step=1.0,
+        disabled=st.session_state.is_running,
+        help="Les étapes IA qui ne tiennent plus dans le délai sont remplacées par l'analyse locale."
+    )
+    profiling_enabled = st.toggle(
+        "Mode profilage (CPU / mémoire)", value=PROFILING_DEFAULT,
+        disabled=st.session_state.is_running,
+        help="Échantillonne les piles d'appels et suit les allocations (tracemalloc) pendant l'analyse. "
+             "Produit un fichier speedscope (flamegraph) et un rapport d'allocations par étape. Ralentit l'analyse."
+    )
 
 st.title("Synthèse de l'Analyse")
 st.markdown("Optimisez votre présélection. Chargez plusieurs CV, analysez-les et identifiez les meilleurs talents.")
@@ -518,38 +1713,82 @@ if analyze_button:
         st.session_state.is_running = True
         st.session_state.all_results = []
         st.session_state.file_contents = {}
+        st.session_state.export_cache = {}
         st.session_state.analysis_done = True
         st.session_state.pop('api_provider_logged', None) 
+        st.session_state.batch_scheduler = scheduler = BatchScheduler(token_budget, deadline_minutes * 60)
 
-        # --- POOL DE CLÉS API (OpenRouter UNIQUEMENT) ---
-        api_keys_pool = []
-        openrouter_model = "mistralai/mistral-7b-instruct:free" 
-        # --- CORRECTION URL ---
-        # Définir l'URL correctement SANS crochets
-        openrouter_url = "https://openrouter.ai/api/v1/chat/completions" 
-        # --- FIN CORRECTION ---
-        if st.secrets.get("OPENROUTER_API_KEY"):
-            api_keys_pool.append({"key": st.secrets.get("OPENROUTER_API_KEY"), "service": "openrouter", "model": openrouter_model, "url": openrouter_url})
-        if st.secrets.get("OPENROUTER_API_KEY_2"):
-             api_keys_pool.append({"key": st.secrets.get("OPENROUTER_API_KEY_2"), "service": "openrouter", "model": openrouter_model, "url": openrouter_url})
+        # --- Imports différés nécessaires au traitement (tenacity / requests) ---
+        import tenacity
+        from requests.exceptions import HTTPError
+
+        # --- POOL DE CLÉS API (OpenRouter UNIQUEMENT, mis en cache) ---
+        api_keys_pool = get_api_keys_pool()
         if not api_keys_pool:
+            get_api_keys_pool.clear() # Ne pas garder en cache un pool vide (secrets ajoutés plus tard)
             st.error("❌ Aucune clé OpenRouter configurée dans st.secrets.")
             st.session_state.is_running = False
             st.stop()
-        st.info(f"Pool de {len(api_keys_pool)} clés OpenRouter ({openrouter_model}).")
+        st.info(f"Pool de {len(api_keys_pool)} clés OpenRouter ({OPENROUTER_MODEL}).")
         # --- FIN POOL ---
 
+        # --- PROFILAGE (arrêté après l'affichage des résultats, en fin de script) ---
+        if st.session_state.profiler is not None: st.session_state.profiler.stop() # Run précédent interrompu
+        st.session_state.profiling_report = None
+        st.session_state.profiler = RunProfiler() if profiling_enabled else None
+        if st.session_state.profiler is not None: st.session_state.profiler.start()
+
         progress_bar = st.progress(0, text="Initialisation...")
         total_files = len(uploaded_files); start_time = time.time()
-        stage_counts = {"extraction_ok": 0, "stage1_ok": 0, "stage2b_ok": 0, "stage3_ok": 0, "fallback_used": 0, "failed_total": 0}
-
-        for i, uploaded_file in enumerate(uploaded_files):
+        stage_counts = {"extraction_ok": 0, "stage1_ok": 0, "stage1_batched": 0, "stage1_local": 0, "stage2b_ok": 0, "stage3_ok": 0, "fallback_used": 0, "failed_total": 0}
+
+        # --- ÉTAPE 0: Extraction (tous les CV d'abord, pour permettre le screening groupé) ---
+        # Les PDF sont parsés en parallèle dans des sous-processus bornés (taille, pages, temps, mémoire)
+        cv_texts, extraction_statuses = [], []
+        with profiled_stage("extraction"), ThreadPoolExecutor(max_workers=max(1, PDF_WORKERS)) as pdf_pool:
+            parse_futures = [pdf_pool.submit(parse_pdf_isolated, uploaded_file.getvalue()) for uploaded_file in uploaded_files]
+            for i, uploaded_file in enumerate(uploaded_files):
+                progress_bar.progress((i + 1) / total_files, text=f"Extraction {uploaded_file.name} ({i+1}/{total_files})...")
+                file_bytes = uploaded_file.getvalue()
+                st.session_state.file_contents[uploaded_file.name] = file_bytes
+                cv_text, extraction_status = extract_text_from_pdf(io.BytesIO(file_bytes), uploaded_file.name, parse_futures[i].result())
+                cv_texts.append(cv_text); extraction_statuses.append(extraction_status)
+
+        # --- Extraction locale déterministe (contact, langues, expérience) avec confiance par champ ---
+        with profiled_stage("extraction_locale"):
+            local_profiles = [extract_local_profile(cv_text) if cv_text else None for cv_text in cv_texts]
+
+        # --- ORDONNANCEMENT: CV les plus prometteurs d'abord (pré-score local) ---
+        processing_order = scheduler.order_by_prescore(cv_texts, job_description)
+
+        # --- ÉTAPE 1 (mode groupé) ---
+        batched_screening_data = {}
+        if batch_screening:
+            # Les CV entièrement couverts par l'extraction locale n'ont pas besoin de l'IA, mais
+            # réservent quand même leur analyse qualitative dans le budget
+            candidate_items = [(f"cv_{i}", cv_texts[i], bool(low_confidence_fields(local_profiles[i]))) for i in processing_order
+                               if cv_texts[i] and len(cv_texts[i]) > 100]
+            batch_items = scheduler.select_for_batched_screening(candidate_items, job_description)
+            if len(batch_items) > 1:
+                progress_bar.progress(0, text=f"Screening groupé de {len(batch_items)} CV...")
+                batch_profiles = {cv_id: local_profiles[int(cv_id[3:])] for cv_id, _ in batch_items}
+                with profiled_stage("screening_groupe"):
+                    batched_screening_data = run_batched_screening(batch_items, job_description, api_keys_pool, batch_profiles)
+                stage_counts["stage1_batched"] = len(batched_screening_data)
+
+        stage_pool = get_stage_executor() # Étapes d'un même CV en parallèle (voir STAGE_DEPENDENCIES)
+        for rank, i in enumerate(processing_order):
+            uploaded_file = uploaded_files[i]
             key_config_1 = api_keys_pool[i % len(api_keys_pool)] 
             key_config_2 = api_keys_pool[(i + 1) % len(api_keys_pool)] 
+            cv_start_time = time.time()
+            llm_called = False
 
             filename = uploaded_file.name
-            progress_text = f"Analyse {filename} ({i+1}/{total_files})..."
-            progress_bar.progress((i + 1) / total_files, text=progress_text)
+            progress_text = f"Analyse {filename} ({rank+1}/{total_files})..."
+            progress_suffix = scheduler.progress_suffix(rank, total_files)
+            if progress_suffix: progress_text += f" — {progress_suffix}"
+            progress_bar.progress((rank + 1) / total_files, text=progress_text)
 
             # --- Initialize results dict ---
             final_result = {
@@ -558,76 +1797,147 @@ if analyze_button:
                 "points_forts_cles": [], "points_faibles_risques": [], "adequation_poste": "",
                 "evaluation_technologies_cles": "", # <- AJOUTER CETTE LIGNE
                 "analyse_ats": {"mots_cles_trouves": [], "mots_cles_manquants": [], "stabilite": "N/A", "raffinement_ia": False},
-                "web_links": [], "analysis_type": "Échec Initial"
+                "web_links": [], "analysis_type": "Échec Initial",
+                "statut_extraction": extraction_statuses[i]
             }
 
-            # --- ÉTAPE 0: Extraction ---
-            file_bytes = uploaded_file.getvalue()
-            st.session_state.file_contents[filename] = file_bytes
-            cv_text = extract_text_from_pdf(io.BytesIO(file_bytes), filename)
+            cv_text = cv_texts[i]
 
             if cv_text and len(cv_text) > 100: 
                 stage_counts["extraction_ok"] += 1
-                screening_data = None
                 qualitative_data = None
                 refined_keywords_data = None
+                local_profile = local_profiles[i]
+                screening_local = not low_confidence_fields(local_profile)
+                screening_data = batched_screening_data.get(f"cv_{i}")
+                if screening_local:
+                    screening_data = validate_stage_data(local_screening_values(local_profile), "screening")
+                planned_stages = scheduler.plan_stages(cv_text, job_description, total_files - rank - 1, screening_done=bool(screening_data))
+                if planned_stages != set(BatchScheduler.STAGE_PRIORITY):
+                    skipped = [stage for stage in BatchScheduler.STAGE_PRIORITY if stage not in planned_stages]
+                    st.write(f"📄 {filename}: budget/délai — étapes remplacées par l'analyse locale : {', '.join(skipped)}")
                 
-                # --- ÉTAPE 1: Screening IA ---
-                st.write(f"📄 {filename}: Étape 1 - Screening IA...")
-                try:
-                    screening_data = call_screening_ia(cv_text, job_description, key_config_1)
-                    if screening_data:
-                        final_result.update(screening_data) 
-                        final_result["analysis_type"] = "IA Screening + Mots Clés Locaux" 
-                        stage_counts["stage1_ok"] += 1
-                    else:
-                         logger.warning(f"Screening IA a retourné None pour {filename}.")
-                         final_result["analysis_type"] = "Basique + Mots Clés Locaux" 
-                         stage_counts["fallback_used"] += 1 
-                # Catch specific retry error for better logging
-                except tenacity.RetryError as e:
-                     st.error(f"Screening IA échoué pour {filename} après {e.attempt_number} tentatives. Erreur finale: {e.last_attempt.exception()}", icon="🚨")
-                     if isinstance(e.last_attempt.exception(), HTTPError) and e.last_attempt.exception().response.status_code == 429:
-                          st.error("ERREUR 429 : LIMITE QUOTIDIENNE OpenRouter atteinte?", icon="⏳")
-                     final_result["analysis_type"] = "Basique + Mots Clés Locaux"
-                     stage_counts["fallback_used"] += 1
-                except Exception as e:
-                     st.error(f"Erreur inattendue Screening IA {filename}: {e}", icon="💥")
-                     logger.exception(f"Traceback complet Screening IA {filename}:")
-                     final_result["analysis_type"] = "Basique + Mots Clés Locaux"
-                     stage_counts["fallback_used"] += 1
-                     
-                # Fallback pour nom/score/resume si screening échoue
-                if not screening_data:
-                     # ---- CORRECTION APPEL FALLBACK ----
-                     # Appel de la fonction définie correctement
-                     basic_fallback_data = get_basic_fallback_info(cv_text, job_description, filename) 
-                     final_result["nom"] = basic_fallback_data["nom"]
-                     final_result["score"] = basic_fallback_data["score"]
-                     final_result["resume_profil"] = basic_fallback_data["resume_profil"] # Clé cohérente
-                     # ---- FIN CORRECTION ----
-                     
-                # --- ÉTAPE 2: Analyse Mots Clés (Local + IA) ---
+                # --- ÉTAPE 2 (locale): Mots-clés bruts, seule entrée du raffinement IA (2b) ---
                 st.write(f"📄 {filename}: Étape 2 - Mots Clés...")
-                local_ats_analysis = perform_local_analysis(cv_text, job_description)
+                with profiled_stage("analyse_locale"):
+                    local_ats_analysis = perform_local_analysis(cv_text, job_description, local_profile)
                 mots_cles_trouves_bruts = local_ats_analysis.get("mots_cles_trouves", [])
                 mots_cles_manquants_bruts = local_ats_analysis.get("mots_cles_manquants", [])
-                
-                refined_keywords_data = None
-                if mots_cles_trouves_bruts or mots_cles_manquants_bruts:
-                     try:
-                          refined_keywords_data = call_keyword_refinement_ia(
-                               mots_cles_trouves_bruts, mots_cles_manquants_bruts, 
-                               cv_text, job_description, key_config_2 
-                          )
-                          if refined_keywords_data:
-                               stage_counts["stage2b_ok"] += 1
-                          else: logger.warning(f"Raffinement IA a retourné None pour {filename}.")
-                     except tenacity.RetryError as e: st.error(f"Raffinement Mots-clés IA échoué {filename}: {e.last_attempt.exception()}", icon="🚨")
-                     except Exception as e: st.error(f"Erreur inattendue Raffinement Mots-clés IA {filename}: {e}", icon="💥")
+                final_result["analyse_ats"]["stabilite"] = local_ats_analysis.get("stabilite", "N/A")
+
+                # --- GRAPHE D'ÉTAPES: 1 -> (3 || 4) sur la clé 1 / DDG, en parallèle de 2b sur la clé 2 ---
+                # Les fonctions lisent les variables du CV courant : le graphe est terminé avant le CV suivant.
+                run_screening_ia = not screening_data and "screening" in planned_stages
+                if screening_data and screening_local:
+                    st.write(f"📄 {filename}: Étape 1 - Extraction locale (confiance élevée, appel IA évité) ✔")
+                    stage_counts["stage1_local"] += 1
+                elif screening_data:
+                    st.write(f"📄 {filename}: Étape 1 - Screening IA (groupé) ✔")
+                elif run_screening_ia:
+                    low_fields = low_confidence_fields(local_profile)
+                    st.write(f"📄 {filename}: Étape 1 - Screening IA ({len(low_fields)}/{len(LOCAL_PROFILE_FIELDS)} champs, le reste en local)...")
+                    llm_called = True
+                stage_graph = {"screening": (STAGE_DEPENDENCIES["screening"], lambda results: run_timed_stage(
+                    scheduler, "screening", call_screening_ia, cv_text, job_description, key_config_1, local_profile) if run_screening_ia else screening_data)}
+                if (mots_cles_trouves_bruts or mots_cles_manquants_bruts) and "keywords" in planned_stages:
+                    st.write(f"📄 {filename}: Étape 2b - Raffinement Mots Clés IA (en parallèle)...")
+                    llm_called = True
+                    stage_graph["keywords"] = (STAGE_DEPENDENCIES["keywords"], lambda results: run_timed_stage(
+                        scheduler, "keywords", call_keyword_refinement_ia,
+                        mots_cles_trouves_bruts, mots_cles_manquants_bruts, cv_text, job_description, key_config_2))
+                if "qualitative" in planned_stages: # Lancée seulement si le screening a réussi
+                    stage_graph["qualitative"] = (STAGE_DEPENDENCIES["qualitative"], lambda results: run_timed_stage(
+                        scheduler, "qualitative", call_qualitative_ia, cv_text, job_description, results["screening"], key_config_1) if results["screening"] else None)
+                if "web" in planned_stages: # Nom et LinkedIn lus après fusion du screening (ou du fallback)
+                    stage_graph["web"] = (STAGE_DEPENDENCIES["web"], lambda results: run_timed_stage(
+                        scheduler, "web", perform_web_search, final_result.get("nom"), final_result.get("contact", {}).get("linkedin")))
+
+                for stage, stage_future in run_stage_graph(stage_graph, stage_pool):
+                    # --- ÉTAPE 1: Screening IA (résultat groupé, local, sinon appel unitaire) ---
+                    if stage == "screening":
+                        try:
+                            screening_data = stage_future.result()
+                            if screening_data:
+                                final_result.update(screening_data) 
+                                final_result["analysis_type"] = "IA Screening + Mots Clés Locaux" 
+                                stage_counts["stage1_ok"] += 1
+                            else:
+                                 if run_screening_ia: logger.warning(f"Screening IA a retourné None pour {filename}.")
+                                 final_result["analysis_type"] = "Basique + Mots Clés Locaux" 
+                                 stage_counts["fallback_used"] += 1 
+                        # Catch specific retry error for better logging
+                        except tenacity.RetryError as e:
+                             st.error(f"Screening IA échoué pour {filename} après {e.attempt_number} tentatives. Erreur finale: {e.last_attempt.exception()}", icon="🚨")
+                             if isinstance(e.last_attempt.exception(), HTTPError) and e.last_attempt.exception().response.status_code == 429:
+                                  st.error("ERREUR 429 : LIMITE QUOTIDIENNE OpenRouter atteinte?", icon="⏳")
+                             final_result["analysis_type"] = "Basique + Mots Clés Locaux"
+                             stage_counts["fallback_used"] += 1
+                        except Exception as e:
+                             st.error(f"Erreur inattendue Screening IA {filename}: {e}", icon="💥")
+                             logger.exception(f"Traceback complet Screening IA {filename}:")
+                             final_result["analysis_type"] = "Basique + Mots Clés Locaux"
+                             stage_counts["fallback_used"] += 1
+                             
+                        # Fallback pour nom/score/resume si screening échoue
+                        if not screening_data:
+                             # ---- CORRECTION APPEL FALLBACK ----
+                             # Appel de la fonction définie correctement
+                             basic_fallback_data = get_basic_fallback_info(cv_text, job_description, filename) 
+                             final_result["nom"] = basic_fallback_data["nom"]
+                             final_result["score"] = basic_fallback_data["score"]
+                             final_result["resume_profil"] = basic_fallback_data["resume_profil"] # Clé cohérente
+                             # Contact / langues / diplôme / expérience : extraction locale plutôt que des champs vides
+                             local_values = local_screening_values(local_profile)
+                             local_values.pop("nom")
+                             final_result.update(local_values)
+                             if "screening" not in planned_stages:
+                                  final_result["resume_profil"] = "Analyse IA non lancée (budget ou délai du lot atteint). Score basé sur mots-clés."
+                             # ---- FIN CORRECTION ----
+                        if screening_data and "qualitative" in stage_graph:
+                             st.write(f"📄 {filename}: Étape 3 - Analyse Qualitative IA...")
+                             llm_called = True
+                        if "web" in stage_graph:
+                             st.write(f"📄 {filename}: Étape 4 - Recherche Web (en parallèle)...")
+
+                    # --- ÉTAPE 2b: Raffinement Mots Clés IA ---
+                    elif stage == "keywords":
+                        try:
+                             refined_keywords_data = stage_future.result()
+                             if refined_keywords_data:
+                                  stage_counts["stage2b_ok"] += 1
+                             else: logger.warning(f"Raffinement IA a retourné None pour {filename}.")
+                        except tenacity.RetryError as e: st.error(f"Raffinement Mots-clés IA échoué {filename}: {e.last_attempt.exception()}", icon="🚨")
+                        except Exception as e: st.error(f"Erreur inattendue Raffinement Mots-clés IA {filename}: {e}", icon="💥")
+
+                    # --- ÉTAPE 3: Analyse Qualitative IA ---
+                    elif stage == "qualitative":
+                        if not screening_data: continue # Non lancée (screening en échec)
+                        try:
+                             qualitative_data = stage_future.result()
+                             if qualitative_data:
+                                  final_result.update(qualitative_data) 
+                                  final_result["analysis_type"] = "IA Complète" 
+                                  stage_counts["stage3_ok"] += 1
+                             else:
+                                  logger.warning(f"Analyse Qualitative a retourné None pour {filename}.")
+                        except tenacity.RetryError as e: st.error(f"Analyse Qualitative IA échouée {filename}: {e.last_attempt.exception()}", icon="🚨")
+                        except Exception as e: st.error(f"Erreur inattendue Analyse Qualitative IA {filename}: {e}", icon="💥")
+
+                    # --- ÉTAPE 4: Recherche Web ---
+                    elif stage == "web":
+                        try:
+                            final_result["web_links"] = stage_future.result()
+                        except tenacity.RetryError as e:
+                            st.warning(f"Recherche Web pour {filename} échouée après {e.attempt_number} tentatives (Ratelimit de DDGS).", icon="🌐")
+                            logger.warning(f"DDGS Ratelimit final pour {filename}: {e.last_attempt.exception()}")
+                            final_result["web_links"] = [] # On continue avec une liste vide
+                        except Exception as e:
+                            # Sécurité pour attraper d'autres erreurs inattendues de la recherche web
+                            st.error(f"Erreur inattendue recherche Web {filename}: {e}", icon="💥")
+                            logger.exception(f"Traceback complet recherche Web {filename}:")
+                            final_result["web_links"] = [] # On continue avec une liste vide
 
                 # Update final_result["analyse_ats"]
-                final_result["analyse_ats"]["stabilite"] = local_ats_analysis.get("stabilite", "N/A")
                 if refined_keywords_data:
                     final_result["analyse_ats"]["mots_cles_trouves"] = refined_keywords_data.get("mots_cles_trouves_filtres", mots_cles_trouves_bruts)
                     final_result["analyse_ats"]["mots_cles_manquants"] = refined_keywords_data.get("mots_cles_manquants_prioritaires", mots_cles_manquants_bruts)
@@ -637,45 +1947,15 @@ if analyze_button:
                     final_result["analyse_ats"]["mots_cles_manquants"] = mots_cles_manquants_bruts
                     final_result["analyse_ats"]["raffinement_ia"] = False
 
-                # --- ÉTAPE 3: Analyse Qualitative IA ---
-                if screening_data: # Attempt only if screening was successful
-                     st.write(f"📄 {filename}: Étape 3 - Analyse Qualitative IA...")
-                     try:
-                          qualitative_data = call_qualitative_ia(cv_text, job_description, screening_data, key_config_1) 
-                          if qualitative_data:
-                               final_result.update(qualitative_data) 
-                               final_result["analysis_type"] = "IA Complète" 
-                               stage_counts["stage3_ok"] += 1
-                          else:
-                               logger.warning(f"Analyse Qualitative a retourné None pour {filename}.")
-                               # If stage 3 fails, but stage 1 was ok, ensure score exists
-                               if final_result.get("score", 0) == 0: 
-                                    basic_fallback_score = get_basic_fallback_info(cv_text, job_description, filename)["score"]
-                                    final_result["score"] = basic_fallback_score
-                     except tenacity.RetryError as e: st.error(f"Analyse Qualitative IA échouée {filename}: {e.last_attempt.exception()}", icon="🚨")
-                     except Exception as e: st.error(f"Erreur inattendue Analyse Qualitative IA {filename}: {e}", icon="💥")
-
-                # --- ÉTAPE 4: Recherche Web ---
-                st.write(f"📄 {filename}: Étape 4 - Recherche Web...")
-                try:
-                    linkedin_url = final_result.get("contact", {}).get("linkedin")
-                    # Tenacity est déjà importé en haut de notre fichier
-                    web_links = perform_web_search(final_result.get("nom"), linkedin_url)
-                    final_result["web_links"] = web_links
-                except tenacity.RetryError as e:
-                    st.warning(f"Recherche Web pour {filename} échouée après {e.attempt_number} tentatives (Ratelimit de DDGS).", icon="🌐")
-                    logger.warning(f"DDGS Ratelimit final pour {filename}: {e.last_attempt.exception()}")
-                    final_result["web_links"] = [] # On continue avec une liste vide
-                except Exception as e:
-                    # Sécurité pour attraper d'autres erreurs inattendues de la recherche web
-                    st.error(f"Erreur inattendue recherche Web {filename}: {e}", icon="💥")
-                    logger.exception(f"Traceback complet recherche Web {filename}:")
-                    final_result["web_links"] = [] # On continue avec une liste vide
+                # If stage 3 fails or is skipped (budget), but stage 1 was ok, ensure score exists
+                if screening_data and not qualitative_data and final_result.get("score", 0) == 0: 
+                     basic_fallback_score = get_basic_fallback_info(cv_text, job_description, filename)["score"]
+                     final_result["score"] = basic_fallback_score
 
             else: # PDF illisible ou trop court
                  error_msg = f"Impossible d'extraire assez de texte de {filename}."
                  if cv_text is not None: error_msg += f" ({len(cv_text)} car.). Analyse impossible."
-                 else: error_msg += " Fichier illisible."
+                 else: error_msg += f" Statut : {extraction_statuses[i]}."
                  st.error(error_msg)
                  final_result.update({
                       "nom": "Erreur Extraction", "score": 0, "resume_profil": error_msg,
@@ -692,20 +1972,26 @@ if analyze_button:
 
             st.session_state.all_results.append(final_result)
                  
-            # --- PAUSE ENTRE CVs ---
-            time.sleep(3.0) 
+            # --- PAUSE ENTRE CVs (inutile si aucun appel IA n'a eu lieu pour ce CV) ---
+            if llm_called:
+                time.sleep(BatchScheduler.CV_PAUSE_SECONDS) 
+            scheduler.record_cv_time(time.time() - cv_start_time)
+        stage_pool.shutdown()
 
         # --- Finalisation & Reporting ---
         progress_bar.empty(); st.session_state.is_running = False
         total_time = time.time() - start_time
         api_used_log = st.session_state.get('api_provider_logged', 'Aucun appel IA réussi')
-        st.info(f"Analyse terminée en {total_time:.1f}s. (API utilisée: {api_used_log})")
+        st.info(f"Analyse terminée en {total_time:.1f}s. (API utilisée: {api_used_log} | Tokens consommés: {scheduler.tokens_used}"
+                + (f"/{scheduler.token_budget}" if scheduler.token_budget else "") + ")")
         
         st.write("---")
         st.subheader("Résumé du Traitement :")
         cols = st.columns(3)
         cols[0].metric("CV Lus", f"{stage_counts['extraction_ok']}/{total_files}")
-        cols[1].metric("Screening IA OK", f"{stage_counts['stage1_ok']}/{stage_counts['extraction_ok']}")
+        cols[1].metric("Screening IA OK", f"{stage_counts['stage1_ok']}/{stage_counts['extraction_ok']}",
+                       help=f"Dont {stage_counts['stage1_local']} par extraction locale seule"
+                            + (f" et {stage_counts['stage1_batched']} via screening groupé." if batch_screening else "."))
         cols[2].metric("Analyse Quali. IA OK", f"{stage_counts['stage3_ok']}/{stage_counts['stage1_ok']}") 
         
         final_ia_complete = sum(1 for r in st.session_state.all_results if r['analysis_type'] == "IA Complète")
@@ -723,149 +2009,164 @@ if analyze_button:
 if st.session_state.analysis_done and st.session_state.all_results:
     sorted_results = sorted(st.session_state.all_results, key=lambda x: x.get('score', 0), reverse=True)
 
-    try: # Export CSV
-        df = pd.DataFrame(st.session_state.all_results)
-        if not df.empty:
-            if 'analyse_ats' in df.columns:
-                 df['analyse_ats'] = df['analyse_ats'].apply(lambda x: x if isinstance(x, dict) else {})
-                 df['ats.mots_cles_trouves'] = df['analyse_ats'].apply(lambda x: "; ".join(x.get('mots_cles_trouves', [])))
-                 df['ats.mots_cles_manquants'] = df['analyse_ats'].apply(lambda x: "; ".join(x.get('mots_cles_manquants', [])))
-                 df['ats.stabilite'] = df['analyse_ats'].apply(lambda x: x.get('stabilite', 'N/A'))
-                 df['ats.raffinement_ia'] = df['analyse_ats'].apply(lambda x: x.get('raffinement_ia', False))
-                 if 'analyse_ats' in df.columns: df = df.drop(columns=['analyse_ats'])
-            if 'contact' in df.columns:
-                 df['contact'] = df['contact'].apply(lambda x: x if isinstance(x, dict) else {})
-                 df['contact.email'] = df['contact'].apply(lambda x: x.get('email', ''))
-                 df['contact.telephone'] = df['contact'].apply(lambda x: x.get('telephone', ''))
-                 df['contact.linkedin'] = df['contact'].apply(lambda x: x.get('linkedin', ''))
-                 if 'contact' in df.columns: df = df.drop(columns=['contact'])
-            for col in ["langues", "points_forts_cles", "points_faibles_risques", "web_links"]:
-                 if col in df.columns: df[col] = df[col].apply(lambda x: "; ".join(map(str, x)) if isinstance(x, list) else str(x))
-
-            csv_data = convert_df_to_csv(df.fillna('N/A'))
-            if csv_data:
-                st.download_button(label="Exporter Résultats (CSV)", data=csv_data,
-                                   file_name=f"analyse_cv_v3_{time.strftime('%Y%m%d_%H%M')}.csv",
-                                   mime='text/csv', use_container_width=True)
-            st.markdown("---")
-    except Exception as e: st.error(f"Erreur Export CSV : {e}")
-
-    st.subheader(f"Classement des {len(sorted_results)} Profils Analysés")
-    for i, candidate in enumerate(sorted_results):
-        score = candidate.get('score', 0)
-        nom = candidate.get('nom', 'N/A')
-        nom_fichier = candidate.get('nom_fichier', 'N/A')
-        analysis_type = candidate.get('analysis_type', 'Échec')
-        resume = candidate.get('resume_profil', 'N/A') 
-        contact = candidate.get('contact', {})
-        langues = candidate.get('langues', [])
-        diplome = candidate.get('diplome_principal', '')
-        exp = candidate.get('annees_experience_estimees', 0)
-        points_forts = candidate.get('points_forts_cles', [])
-        points_faibles = candidate.get('points_faibles_risques', [])
-        adequation = candidate.get('adequation_poste', '')
-        eval_tech = candidate.get('evaluation_technologies_cles', '')
-        ats_data = candidate.get('analyse_ats', {})
-        web_links = candidate.get('web_links', [])
-
-        with st.container(border=True):
-            col1, col2 = st.columns([4, 1])
-            with col1:
-                st.markdown(f"### {i+1}. {nom} ({nom_fichier})")
+    try: # Export CSV / JSONL / Parquet (généré à la demande, un seul format gardé en mémoire)
+        export_stamp = time.strftime('%Y%m%d_%H%M')
+        col_fmt, col_prepare, col_download = st.columns(3)
+        export_fmt = col_fmt.selectbox("Format d'export", list(EXPORT_WRITERS), format_func=str.upper, label_visibility="collapsed")
+        if col_prepare.button(f"Préparer l'export {export_fmt.upper()}", use_container_width=True):
+            # L'export est construit après la fin du run profilé : on reprend le profileur de l'analyse
+            if profiling_enabled and st.session_state.profiler is not None and export_fmt not in st.session_state.export_cache:
+                st.session_state.profiler.start()
+            get_export_bytes(export_fmt)
+        if export_fmt in st.session_state.export_cache:
+            col_download.download_button(label=f"Exporter Résultats ({export_fmt.upper()})", data=st.session_state.export_cache[export_fmt],
+                                         file_name=f"analyse_cv_v3_{export_stamp}.{export_fmt}",
+                                         mime=EXPORT_WRITERS[export_fmt][1], use_container_width=True)
+        st.markdown("---")
+    except Exception as e: st.error(f"Erreur Export : {e}")
+
+    with profiled_stage("affichage"): # Rendu des widgets de résultats
+        st.subheader(f"Classement des {len(sorted_results)} Profils Analysés")
+        for i, candidate in enumerate(sorted_results):
+            score = candidate.get('score', 0)
+            nom = candidate.get('nom', 'N/A')
+            nom_fichier = candidate.get('nom_fichier', 'N/A')
+            analysis_type = candidate.get('analysis_type', 'Échec')
+            resume = candidate.get('resume_profil', 'N/A') 
+            contact = candidate.get('contact', {})
+            langues = candidate.get('langues', [])
+            diplome = candidate.get('diplome_principal', '')
+            exp = candidate.get('annees_experience_estimees', 0)
+            points_forts = candidate.get('points_forts_cles', [])
+            points_faibles = candidate.get('points_faibles_risques', [])
+            adequation = candidate.get('adequation_poste', '')
+            eval_tech = candidate.get('evaluation_technologies_cles', '')
+            ats_data = candidate.get('analyse_ats', {})
+            web_links = candidate.get('web_links', [])
+
+            with st.container(border=True):
+                col1, col2 = st.columns([4, 1])
+                with col1:
+                    st.markdown(f"### {i+1}. {nom} ({nom_fichier})")
                 
-                if analysis_type == "IA Complète": st.caption("Analyse : IA Complète ✨")
-                elif analysis_type == "IA Screening + Mots Clés Locaux": st.caption("Analyse : IA Screening + Mots Clés Locaux 🧐")
-                elif analysis_type == "Basique + Mots Clés Locaux": st.caption("Analyse : Basique Fallback + Mots Clés Locaux ⚠️")
-                else: st.caption(f"Analyse : {analysis_type} ❌") 
-
-                contact_parts = []
-                if contact.get('email'): contact_parts.append(f"📧 [{contact['email']}](mailto:{contact['email']})")
-                if contact.get('telephone'): contact_parts.append(f"📞 {contact['telephone']}")
-                if contact.get('linkedin'): contact_parts.append(f"🔗 [LinkedIn]({contact['linkedin']})")
-                if contact_parts: st.markdown(" | ".join(contact_parts))
-
-                info_line = []
-                if langues: info_line.append(f"🗣️ {', '.join(langues)}")
-                if diplome: info_line.append(f"🎓 {diplome}")
-                if exp > 0: info_line.append(f"⏳ {exp} an(s) exp.")
-                if info_line: st.markdown(" | ".join(info_line))
-
-                st.markdown(f"**Résumé :** *{resume}*")
-
-            with col2:
-                st.metric(label="Score", value=f"{score}%")
-                if nom_fichier in st.session_state.file_contents:
-                     st.download_button(label="Télécharger CV", data=st.session_state.file_contents[nom_fichier],
-                                        file_name=nom_fichier, mime="application/pdf", key=f"btn_{nom_fichier}_{i}")
-
-            if analysis_type not in ["Échec Extraction", "Échec", "Échec Initial"]: # Show details only if some analysis happened
-                st.markdown("---")
+                    if analysis_type == "IA Complète": st.caption("Analyse : IA Complète ✨")
+                    elif analysis_type == "IA Screening + Mots Clés Locaux": st.caption("Analyse : IA Screening + Mots Clés Locaux 🧐")
+                    elif analysis_type == "Basique + Mots Clés Locaux": st.caption("Analyse : Basique Fallback + Mots Clés Locaux ⚠️")
+                    else: st.caption(f"Analyse : {analysis_type} ❌") 
+                    statut_extraction = candidate.get("statut_extraction", "OK")
+                    if statut_extraction not in ("OK", "N/A"): st.caption(f"Extraction PDF : {statut_extraction} ✂️")
+
+                    contact_parts = []
+                    if contact.get('email'): contact_parts.append(f"📧 [{contact['email']}](mailto:{contact['email']})")
+                    if contact.get('telephone'): contact_parts.append(f"📞 {contact['telephone']}")
+                    if contact.get('linkedin'): contact_parts.append(f"🔗 [LinkedIn]({contact['linkedin']})")
+                    if contact_parts: st.markdown(" | ".join(contact_parts))
+
+                    info_line = []
+                    if langues: info_line.append(f"🗣️ {', '.join(langues)}")
+                    if diplome: info_line.append(f"🎓 {diplome}")
+                    if exp > 0: info_line.append(f"⏳ {exp} an(s) exp.")
+                    if info_line: st.markdown(" | ".join(info_line))
+
+                    st.markdown(f"**Résumé :** *{resume}*")
+
+                with col2:
+                    st.metric(label="Score", value=f"{score}%")
+                    if nom_fichier in st.session_state.file_contents:
+                         st.download_button(label="Télécharger CV", data=st.session_state.file_contents[nom_fichier],
+                                            file_name=nom_fichier, mime="application/pdf", key=f"btn_{nom_fichier}_{i}")
+
+                if analysis_type not in ["Échec Extraction", "Échec", "Échec Initial"]: # Show details only if some analysis happened
+                    st.markdown("---")
                 
-                tabs_list = ["📊 Analyse ATS"] 
-                if analysis_type == "IA Complète":
-                     tabs_list.insert(0, "🧑‍💼 Avis Qualitatif") 
-                if web_links:
-                     tabs_list.append("🌐 Liens Web")
+                    tabs_list = ["📊 Analyse ATS"] 
+                    if analysis_type == "IA Complète":
+                         tabs_list.insert(0, "🧑‍💼 Avis Qualitatif") 
+                    if web_links:
+                         tabs_list.append("🌐 Liens Web")
                      
-                tabs = st.tabs(tabs_list)
-                tab_index = 0
-
-                if "🧑‍💼 Avis Qualitatif" in tabs_list:
+                    tabs = st.tabs(tabs_list)
+                    tab_index = 0
+
+                    if "🧑‍💼 Avis Qualitatif" in tabs_list:
+                        with tabs[tab_index]:
+                            st.subheader("Avis Qualitatif (IA)")
+                            if adequation: st.markdown(f"**Adéquation au poste :** {adequation}")
+                            if eval_tech:
+                                st.markdown(f"**Évaluation Technologies Clés :**")
+                                st.info(f"{eval_tech}", icon="💻")
+                            st.markdown("**Points Forts Clés :**")
+                            if points_forts: 
+                                for p in points_forts: st.markdown(f"- {p}") # Boucle correcte
+                            else: st.info("-")
+                            st.markdown("**Points Faibles / Risques :**")
+                            if points_faibles: 
+                                for p in points_faibles: st.warning(p, icon="🚩") # Boucle correcte
+                            else: st.info("-")
+                        tab_index += 1
+
+                    # ATS Tab 
                     with tabs[tab_index]:
-                        st.subheader("Avis Qualitatif (IA)")
-                        if adequation: st.markdown(f"**Adéquation au poste :** {adequation}")
-                        if eval_tech:
-                            st.markdown(f"**Évaluation Technologies Clés :**")
-                            st.info(f"{eval_tech}", icon="💻")
-                        st.markdown("**Points Forts Clés :**")
-                        if points_forts: 
-                            for p in points_forts: st.markdown(f"- {p}") # Boucle correcte
-                        else: st.info("-")
-                        st.markdown("**Points Faibles / Risques :**")
-                        if points_faibles: 
-                            for p in points_faibles: st.warning(p, icon="🚩") # Boucle correcte
-                        else: st.info("-")
-                    tab_index += 1
-
-                # ATS Tab 
-                with tabs[tab_index]:
-                    st.subheader("Analyse Technique (Mots Clés)")
-                    raffinement_ok = ats_data.get('raffinement_ia', False)
-                    if raffinement_ok: st.caption("Mots-clés filtrés par IA ✨")
-                    else: st.caption("Mots-clés bruts/locaux ⚠️")
+                        st.subheader("Analyse Technique (Mots Clés)")
+                        raffinement_ok = ats_data.get('raffinement_ia', False)
+                        if raffinement_ok: st.caption("Mots-clés filtrés par IA ✨")
+                        else: st.caption("Mots-clés bruts/locaux ⚠️")
                         
-                    col_ats1, col_ats2 = st.columns(2)
-                    with col_ats1:
-                        st.markdown("**Mots-clés trouvés :**")
-                        mkt = ats_data.get('mots_cles_trouves', [])
-                        # --- CORRECTION UI ATS ---
-                        # Afficher la liste directement si elle existe
-                        if mkt: st.success(f"{', '.join(mkt)}", icon="✅")
-                        else: st.info("-")
-                        # --- FIN CORRECTION ---
-                        st.markdown("**Stabilité (Estimation) :**")
-                        st.info(f"{ats_data.get('stabilite', 'N/A')}", icon="⏳")
-                    with col_ats2:
-                        st.markdown("**Mots-clés manquants :**")
-                        mkm = ats_data.get('mots_cles_manquants', [])
-                        # --- CORRECTION UI ATS ---
-                        # Afficher la liste directement si elle existe
-                        if mkm: st.error(f"{', '.join(mkm)}", icon="❌")
-                        else: st.info("-")
-                        # --- FIN CORRECTION ---
-                tab_index += 1
+                        col_ats1, col_ats2 = st.columns(2)
+                        with col_ats1:
+                            st.markdown("**Mots-clés trouvés :**")
+                            mkt = ats_data.get('mots_cles_trouves', [])
+                            # --- CORRECTION UI ATS ---
+                            # Afficher la liste directement si elle existe
+                            if mkt: st.success(f"{', '.join(mkt)}", icon="✅")
+                            else: st.info("-")
+                            # --- FIN CORRECTION ---
+                            st.markdown("**Stabilité (Estimation) :**")
+                            st.info(f"{ats_data.get('stabilite', 'N/A')}", icon="⏳")
+                        with col_ats2:
+                            st.markdown("**Mots-clés manquants :**")
+                            mkm = ats_data.get('mots_cles_manquants', [])
+                            # --- CORRECTION UI ATS ---
+                            # Afficher la liste directement si elle existe
+                            if mkm: st.error(f"{', '.join(mkm)}", icon="❌")
+                            else: st.info("-")
+                            # --- FIN CORRECTION ---
+                    tab_index += 1
                 
-                if "🌐 Liens Web" in tabs_list:
-                     with tabs[tab_index]:
-                         st.subheader("Présence en Ligne (Liens trouvés)")
-                         if web_links:
-                              for link in web_links: st.markdown(f"- [{link}]({link})")
-                         else:
-                              st.info("Aucun lien pertinent trouvé.")
-                     tab_index += 1
+                    if "🌐 Liens Web" in tabs_list:
+                         with tabs[tab_index]:
+                             st.subheader("Présence en Ligne (Liens trouvés)")
+                             if web_links:
+                                  for link in web_links: st.markdown(f"- [{link}]({link})")
+                             else:
+                                  st.info("Aucun lien pertinent trouvé.")
+                         tab_index += 1
 
 
 elif not st.session_state.is_running and st.session_state.analysis_done and not st.session_state.all_results:
     st.error("L'analyse a terminé, mais aucun CV n'a pu être traité.")
 elif not st.session_state.is_running:
-    st.info("Prêt à analyser. Remplissez l'offre et chargez les CV.")
\ No newline at end of file
+    st.info("Prêt à analyser. Remplissez l'offre et chargez les CV.")
+
+# --- RAPPORT DE PROFILAGE (mode opt-in) ---
+# Le profileur arrêté reste en session : un export préparé ensuite le reprend et complète le rapport.
+if st.session_state.profiler is not None and st.session_state.profiler.running and not st.session_state.is_running:
+    profiler = st.session_state.profiler
+    profiler.stop()
+    st.session_state.profiling_report = {
+        "speedscope": profiler.to_speedscope(),
+        "allocations": profiler.allocation_report(),
+        "stamp": time.strftime('%Y%m%d_%H%M'),
+    }
+if st.session_state.profiling_report:
+    report = st.session_state.profiling_report
+    with st.expander("🔬 Rapport de profilage (CPU / mémoire)"):
+        st.caption("Ouvrir le fichier .speedscope.json sur https://www.speedscope.app (vue « Left Heavy » : une racine par étape).")
+        col_prof1, col_prof2 = st.columns(2)
+        col_prof1.download_button("Télécharger le flamegraph (speedscope)", data=report["speedscope"],
+                                  file_name=f"profil_analyse_{report['stamp']}.speedscope.json",
+                                  mime="application/json", use_container_width=True)
+        col_prof2.download_button("Télécharger le rapport d'allocations", data=report["allocations"],
+                                  file_name=f"allocations_analyse_{report['stamp']}.txt",
+                                  mime="text/plain", use_container_width=True)
+        st.code(report["allocations"], language=None)
@@ -0,0 +1,64 @@
+# --- WORKER D'EXTRACTION PDF ISOLÉ (PyMuPDF dans un sous-processus) ---
+# Lancé par app.parse_pdf_isolated : lit le PDF sur stdin et écrit un JSON sur stdout.
+# Les limites mémoire / CPU sont posées sur ce processus (resource.setrlimit) : un PDF
+# pathologique ne peut ni bloquer ni gonfler le processus Streamlit, il est simplement tué.
+#
+# Statuts renvoyés : "ok", "tronque" (limite de pages atteinte), "memoire", "erreur".
+import argparse
+import json
+import sys
+
+def apply_limits(memory_mb, cpu_seconds):
+    """Plafonne la mémoire adressable et le temps CPU du processus (sans effet hors POSIX)."""
+    try:
+        import resource
+    except ImportError: # Windows : seul le timeout du processus parent s'applique
+        return
+    if memory_mb:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_mb * 1024 * 1024, memory_mb * 1024 * 1024))
+    if cpu_seconds:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1))
+
+def extract(pdf_bytes, max_pages, max_scanned_pages, min_page_chars):
+    """Extrait le texte des `max_pages` premières pages pertinentes (au moins `min_page_chars` caractères).
+
+    Les pages sans texte (images de portfolio, pages de garde) ne comptent pas, mais au plus
+    `max_scanned_pages` pages sont ouvertes pour borner le temps passé sur un gros document.
+    """
+    import fitz # PyMuPDF
+    pages, scanned = [], 0
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        total = doc.page_count
+        for page in doc:
+            if len(pages) >= max_pages or scanned >= max_scanned_pages: break
+            scanned += 1
+            text = page.get_text("text", sort=True, flags=fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE)
+            if len(text.strip()) >= min_page_chars: pages.append(text + "\n")
+    return {
+        "statut": "tronque" if scanned < total else "ok",
+        "texte": "".join(pages),
+        "pages_total": total, "pages_lues": scanned, "pages_retenues": len(pages),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Extraction PDF isolée (stdin -> JSON stdout)")
+    parser.add_argument("--max-pages", type=int, default=8)
+    parser.add_argument("--max-scanned-pages", type=int, default=24)
+    parser.add_argument("--min-page-chars", type=int, default=50)
+    parser.add_argument("--memory-mb", type=int, default=0)
+    parser.add_argument("--cpu-seconds", type=int, default=0)
+    args = parser.parse_args()
+
+    apply_limits(args.memory_mb, args.cpu_seconds)
+    pdf_bytes = sys.stdin.buffer.read()
+    try:
+        result = extract(pdf_bytes, args.max_pages, args.max_scanned_pages, args.min_page_chars)
+    except MemoryError:
+        result = {"statut": "memoire", "message": f"Limite mémoire de {args.memory_mb} Mo atteinte."}
+    except Exception as e:
+        result = {"statut": "erreur", "message": f"{type(e).__name__}: {e}"[:300]}
+    sys.stdout.write(json.dumps(result, ensure_ascii=False))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+# --- BENCHMARK TEMPS D'IMPORT (démarrage à froid) ---
+# Lance `python -X importtime -c "import app"` dans un sous-processus propre,
+# puis vérifie que :
+#   1. aucun module lourd (chargé à la demande dans app.py) n'est importé au démarrage ;
+#   2. le temps cumulé d'import de app reste sous le budget fixé.
+# Code retour non nul en cas de régression (utilisable en CI).
+#
+# Usage : python tools/bench_import_time.py [--budget-ms 1500] [--runs 3] [--top 15]
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules qui ne doivent PAS être importés au chargement du script (voir en-tête de app.py)
+LAZY_MODULES = ["pandas", "fitz", "pymupdf", "pyarrow", "duckduckgo_search", "tenacity", "requests", "pydantic"]
+
+DEFAULT_BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", 1500))
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+def run_importtime():
+    """Importe app une fois avec -X importtime et renvoie [(module, self_us, cumul_us, profondeur)]."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=REPO_ROOT, capture_output=True, text=True,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+    )
+    if proc.returncode != 0:
+        sys.exit(f"Échec de l'import de app:\n{proc.stderr[-2000:]}")
+    entries = []
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumul_us, indent, module = match.groups()
+            entries.append((module, int(self_us), int(cumul_us), len(indent) // 2))
+    return entries
+
+def main():
+    parser = argparse.ArgumentParser(description="Garde-fou du temps d'import de app.py")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help="Budget du temps d'import cumulé de app (médiane)")
+    parser.add_argument("--runs", type=int, default=3, help="Nombre d'imports mesurés (la médiane est retenue)")
+    parser.add_argument("--top", type=int, default=15, help="Nombre de modules de 1er niveau affichés")
+    args = parser.parse_args()
+
+    totals_ms, entries = [], []
+    for _ in range(args.runs):
+        entries = run_importtime()
+        app_entry = next((e for e in entries if e[0] == "app"), None)
+        if app_entry is None:
+            sys.exit("Ligne 'app' introuvable dans la sortie -X importtime.")
+        totals_ms.append(app_entry[2] / 1000)
+    total_ms = statistics.median(totals_ms)
+
+    print(f"Temps d'import cumulé de app : {total_ms:.0f} ms (médiane sur {args.runs}, budget {args.budget_ms:.0f} ms)")
+    top_level = sorted((e for e in entries if e[3] <= 1 and e[0] != "app"), key=lambda e: e[2], reverse=True)
+    for module, _, cumul_us, _ in top_level[:args.top]:
+        print(f"  {cumul_us / 1000:8.1f} ms  {module}")
+
+    imported = {e[0].split(".")[0] for e in entries}
+    eager = [m for m in LAZY_MODULES if m in imported]
+    failed = False
+    if eager:
+        print(f"RÉGRESSION : modules lourds importés au démarrage : {', '.join(eager)}")
+        failed = True
+    if total_ms > args.budget_ms:
+        print(f"RÉGRESSION : {total_ms:.0f} ms > budget {args.budget_ms:.0f} ms")
+        failed = True
+    if not failed:
+        print("OK")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())